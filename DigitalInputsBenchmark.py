@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+# Benchmark for the pulse path in dbus_digitalinputs.py
+#
+# Drives the pulse counter backends (EpollPulseCounter, PollingPulseCounter)
+#	and the pin handlers (PinHandler._toggle via VolumeCounter, in count and rate mode,
+#	PinAlarm.toggle via TransferSwitch)
+#	the same way dbus_digitalinputs.py main () does, but from fake sysfs GPIO value files
+#	and with a stub VeDbusService in place of the real one
+#
+# For each backend and handler type it reports:
+#	edges per second sustained
+#	edge to /State latency: from writing the value file to toggle () returning
+#	CPU time per edge (includes writing the value file)
+#	dbus signals per edge the stub service would have emitted
+#
+# --burst n queues n edges before applying them with toggle_batch (), one transaction per gpio,
+#	as the main loop does when edges arrive faster than it drains them
+#
+# --startup instead measures building and registering the handlers for --inputs inputs,
+#	--disabled of them disabled: time, memory allocated and paths added to services already on the bus
+#
+# Edges are generated in lock step with the counter so the figures are the cost of the path itself.
+#	Regular files can't raise the EPOLLPRI a GPIO interrupt does, so the epoll backend gets a stand-in
+#	epoll object that returns immediately - kernel wake-up time is not included.
+#	The polling backend's sleep between scans is skipped and the changed input is made due at once -
+#	on a real system each edge also waits for the next read of that input (on average half its interval).
+#
+# --gpiochip /dev/gpiochipN adds a gpiod row: GpiodPulseCounter on lines 0 .. --inputs - 1 of a gpio-sim
+#	or gpio-mockup chip, driven through the module's pull (gpio-sim) or debugfs event (gpio-mockup) files.
+#	These are real kernel edges, so the latency includes the interrupt and wake-up. Needs root.
+#
+# No dbus, GLib or velib_python is needed - stand-ins are installed before dbus_digitalinputs is imported
+#
+# usage: DigitalInputsBenchmark.py [--file dbus_digitalinputs.py] [--edges n] [--inputs n] [--burst n]
+#			[--startup [--disabled n] [--repeat n]]
+
+import argparse
+import importlib.util
+import os
+import select
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+defaultFile = os.path.join (os.path.dirname (os.path.abspath (__file__)),
+		"FileSets", "v3.20~43", "dbus_digitalinputs.py")
+
+
+# stand-in for velib_python's VeDbusService
+#	counts the change signals the real service would send: one per changed value
+#	or one ItemsChanged for all values changed inside a "with service" block
+class StubVeDbusService:
+
+	# paths added once the service is registered are visible half built and each is announced
+	latePaths = 0
+
+	def __init__ (self, servicename, bus=None, register=True):
+		self.name = servicename
+		self.items = {}
+		self.signals = 0
+		self.inTransaction = False
+		self.transactionChanges = 0
+		self.registered = register
+
+	def register (self):
+		self.registered = True
+
+	def add_path (self, path, value=None, *args, **kwargs):
+		self.items[path] = value
+		if self.registered:
+			StubVeDbusService.latePaths += 1
+
+	def __getitem__ (self, path):
+		return self.items[path]
+
+	def __setitem__ (self, path, value):
+		if self.items.get (path) == value:
+			return
+		self.items[path] = value
+		if self.inTransaction:
+			self.transactionChanges += 1
+		else:
+			self.signals += 1
+
+	def __enter__ (self):
+		self.inTransaction = True
+		self.transactionChanges = 0
+		return self
+
+	def __exit__ (self, *exc):
+		self.inTransaction = False
+		if self.transactionChanges > 0:
+			self.signals += 1
+
+	def __del__ (self):
+		pass
+
+
+# stand-in for dbus.bus.BusConnection - each input service opens its own connection
+class StubBusConnection (object):
+	TYPE_SYSTEM = 0
+	TYPE_SESSION = 1
+
+	def __new__ (cls, *args):
+		return object.__new__ (cls)
+
+	def close (self):
+		pass
+
+
+# stand-in epoll - see above
+#	reports the value files the benchmark marked ready, as the kernel would on an edge
+class StubEpoll:
+
+	def __init__ (self):
+		self.ready = []
+
+	def register (self, fp, mask):
+		pass
+
+	def unregister (self, fp):
+		pass
+
+	def poll (self, timeout=-1):
+		ready = [ (fd, select.EPOLLPRI) for fd in self.ready ]
+		self.ready = []
+		return ready
+
+
+def importDigitalInputs (fileName):
+	dbusModule = types.ModuleType ('dbus')
+	dbusModule.bus = types.ModuleType ('dbus.bus')
+	dbusModule.bus.BusConnection = StubBusConnection
+	dbusModule.exceptions = types.ModuleType ('dbus.exceptions')
+	dbusModule.exceptions.DBusException = Exception
+	dbusModule.mainloop = types.ModuleType ('dbus.mainloop')
+	dbusModule.mainloop.glib = types.ModuleType ('dbus.mainloop.glib')
+	dbusModule.mainloop.glib.DBusGMainLoop = lambda *args, **kwargs: None
+	for name, module in (('dbus', dbusModule), ('dbus.bus', dbusModule.bus),
+			('dbus.exceptions', dbusModule.exceptions), ('dbus.mainloop', dbusModule.mainloop),
+			('dbus.mainloop.glib', dbusModule.mainloop.glib)):
+		sys.modules[name] = module
+
+	gi = types.ModuleType ('gi')
+	gi.repository = types.ModuleType ('gi.repository')
+	gi.repository.GLib = types.ModuleType ('GLib')
+	gi.repository.GLib.timeout_add = lambda *args: 0
+	gi.repository.GLib.idle_add = lambda *args: 0
+	gi.repository.GLib.source_remove = lambda *args: None
+	sys.modules['gi'] = gi
+	sys.modules['gi.repository'] = gi.repository
+
+	vedbus = types.ModuleType ('vedbus')
+	vedbus.VeDbusService = StubVeDbusService
+	vedbus.VeDbusItemImport = object
+	sys.modules['vedbus'] = vedbus
+	settingsdevice = types.ModuleType ('settingsdevice')
+	settingsdevice.SettingsDevice = object
+	sys.modules['settingsdevice'] = settingsdevice
+
+	spec = importlib.util.spec_from_file_location ("dbus_digitalinputs", fileName)
+	module = importlib.util.module_from_spec (spec)
+	spec.loader.exec_module (module)
+	return module
+
+
+# fake sysfs GPIO directory: <root>/gpio<n>/value and edge
+def makeGpio (root, gpio):
+	path = os.path.join (root, "gpio%d" % gpio)
+	os.mkdir (path)
+	with open (os.path.join (path, 'value'), 'wb') as fp:
+		fp.write (b'0\n')
+	with open (os.path.join (path, 'edge'), 'wb') as fp:
+		fp.write (b'none\n')
+	return path
+
+
+def settingsFor (inputType, extra={}):
+	settings = { 'inputtype': inputType, 'rate': 0.001, 'count': 0, 'invert': 0,
+			'invertalarm': 0, 'alarm': 0, 'name': '', 'debounce': 0, 'ratemode': 0 }
+	settings.update (extra)
+	return settings
+
+
+def percentile (values, fraction):
+	ordered = sorted (values)
+	return ordered[min (len (ordered) - 1, int (len (ordered) * fraction))]
+
+
+# returns a function driving a line of a gpio-sim or gpio-mockup chip
+def simulatedLine (gpiochip, line):
+	chip = os.path.basename (gpiochip)
+	pull = "/sys/bus/gpio/devices/%s/sim_gpio%d/pull" % (chip, line)
+	if os.path.exists (pull):
+		fd = os.open (pull, os.O_WRONLY)
+		return fd, lambda level: os.pwrite (fd, b'pull-up' if level else b'pull-down', 0)
+	fd = os.open ("/sys/kernel/debug/gpio-mockup-event/%s/%d" % (chip, line), os.O_WRONLY)
+	return fd, lambda level: os.pwrite (fd, b'1' if level else b'0', 0)
+
+
+def runBenchmark (digitalInputs, backend, handlerType, edges, inputs, burst=1, extraSettings={}, gpiochip=None):
+	root = tempfile.mkdtemp (prefix="digitalinputs")
+	# the polling backend sleeps between scans - skip that so only the scan is measured
+	originalSleep = time.sleep
+	time.sleep = lambda seconds: None
+	try:
+		counter = backend ()
+		epoll = isinstance (counter, digitalInputs.EpollPulseCounter) and gpiochip is None
+		if epoll:
+			counter.ob = StubEpoll ()
+			# measure the interrupt path only - the periodic resync would just add idle reads
+			counter.resync = 0
+
+		handlers = {}
+		writers = {}
+		drivers = {}
+		for gpio in range (1, inputs + 1):
+			if gpiochip is None:
+				path = makeGpio (root, gpio)
+			else:
+				path = "%s:%d" % (gpiochip, gpio - 1)
+				# start low so the first edge is a rising one
+				writers[gpio], drivers[gpio] = simulatedLine (gpiochip, gpio - 1)
+				drivers[gpio] (0)
+			handler = digitalInputs.PinHandler.createHandler (handlerType,
+					None, 'com.victronenergy', path, gpio, settingsFor (handlerType, extraSettings))
+			handler.level = counter.register (path, gpio)
+			handler.refresh ()
+			handlers[gpio] = handler
+			if gpiochip is None:
+				fd = writers[gpio] = os.open (os.path.join (path, 'value'), os.O_WRONLY)
+				drivers[gpio] = lambda level, fd=fd: os.pwrite (fd, b'1\n' if level else b'0\n', 0)
+
+		# the adaptive polling backend waits until an input is due - make the changed one due now
+		polled = isinstance (counter, digitalInputs.PollingPulseCounter) \
+				and hasattr (next (iter (counter.gpiomap.values ())), 'due')
+		pulses = counter ()
+		levels = dict ((gpio, 0) for gpio in handlers)
+		latencies = []
+		startWall = time.perf_counter ()
+		startCpu = time.process_time ()
+		queued = []
+		for edge in range (edges):
+			gpio = edge % inputs + 1
+			levels[gpio] ^= 1
+			edgeTime = time.perf_counter ()
+			drivers[gpio] (levels[gpio])
+			if epoll:
+				counter.ob.ready.append (counter.gpiomap[gpio].fileno ())
+			elif polled:
+				# as if read continuously, so no edges are estimated missed between reads
+				counter.gpiomap[gpio].due = 0
+				counter.gpiomap[gpio].read = time.monotonic ()
+			edge = next (pulses)
+			inp, level = edge[0], edge[1]
+			if burst <= 1:
+				handlers[inp].toggle (level)
+				latencies.append (time.perf_counter () - edgeTime)
+				continue
+			queued.append ((inp, level, edgeTime))
+			if len (queued) >= burst or edge == edges - 1:
+				batches = {}
+				for inp, level, edgeTime in queued:
+					batches.setdefault (inp, []).append (level)
+				for inp, batch in batches.items ():
+					handlers[inp].toggle_batch (batch)
+				doneTime = time.perf_counter ()
+				latencies.extend ([ doneTime - edgeTime for inp, level, edgeTime in queued ])
+				queued = []
+		wall = time.perf_counter () - startWall
+		cpu = time.process_time () - startCpu
+
+		signals = sum (handler.service.signals for handler in handlers.values ())
+		for fd in writers.values ():
+			os.close (fd)
+		if gpiochip is not None:
+			# release the lines for the next run
+			for gpio in handlers:
+				counter.unregister (gpio)
+		return {
+			'edgesPerSecond': edges / wall,
+			'latency50': percentile (latencies, 0.5) * 1e6,
+			'latency99': percentile (latencies, 0.99) * 1e6,
+			'cpuPerEdge': cpu / edges * 1e6,
+			'signalsPerEdge': float (signals) / edges,
+			}
+	finally:
+		time.sleep = originalSleep
+		shutil.rmtree (root)
+
+
+def runStartup (digitalInputs, inputs, disabled, repeat):
+	durations = []
+	for run in range (repeat):
+		StubVeDbusService.latePaths = 0
+		tracemalloc.start ()
+		startTime = time.perf_counter ()
+		handlers = []
+		for gpio in range (1, inputs + 1):
+			handlerType = 0 if gpio <= disabled else 1
+			handlers.append (digitalInputs.PinHandler.createHandler (handlerType,
+					None, 'com.victronenergy', "/dev/gpio/digital_input_%d" % gpio, gpio, settingsFor (handlerType)))
+		for handler in handlers:
+			if hasattr (handler, 'register'):
+				handler.register ()
+		durations.append (time.perf_counter () - startTime)
+		memory = tracemalloc.get_traced_memory ()[0]
+		tracemalloc.stop ()
+		del handlers
+	durations.sort ()
+	return {
+		'duration': durations[len (durations) // 2] * 1e3,
+		'memory': memory / 1024.0,
+		'latePaths': StubVeDbusService.latePaths,
+		}
+
+
+def main ():
+	parser = argparse.ArgumentParser (description="Benchmark the dbus_digitalinputs.py pulse path")
+	parser.add_argument ('--file', default=defaultFile, help="dbus_digitalinputs.py to benchmark")
+	parser.add_argument ('--edges', type=int, default=20000, help="edges per run (default 20000)")
+	parser.add_argument ('--inputs', type=int, default=1, help="number of GPIOs the edges are spread over (default 1)")
+	parser.add_argument ('--burst', type=int, default=1, help="edges applied together with toggle_batch (default 1)")
+	parser.add_argument ('--gpiochip', help="also run the gpiod backend on a gpio-sim or gpio-mockup chip (/dev/gpiochipN)")
+	parser.add_argument ('--startup', action='store_true', help="measure handler startup instead of the pulse path")
+	parser.add_argument ('--disabled', type=int, default=0, help="--startup: number of disabled inputs (default 0)")
+	parser.add_argument ('--repeat', type=int, default=200, help="--startup: runs, the median is reported (default 200)")
+	options = parser.parse_args ()
+
+	digitalInputs = importDigitalInputs (options.file)
+	if options.startup:
+		result = runStartup (digitalInputs, options.inputs, options.disabled, options.repeat)
+		print ("startup of %d input(s), %d disabled - %s" % (options.inputs, options.disabled, options.file))
+		print ("  %0.3f ms  %0.1f KiB allocated  %d paths added after registration"
+				% (result['duration'], result['memory'], result['latePaths']))
+		return
+	backends = [ ("epoll", digitalInputs.EpollPulseCounter), ("poll", digitalInputs.PollingPulseCounter) ]
+	if options.gpiochip:
+		backends.append (("gpiod", digitalInputs.GpiodPulseCounter))
+	handlerTypes = [ ("pulse meter", 1, {}), ("rate meter", 1, { 'ratemode': 1 }), ("transfer switch", 12, {}) ]
+
+	print ("%d edges over %d input(s), burst %d - %s" % (options.edges, options.inputs, options.burst, options.file))
+	print ("%-6s %-16s %12s %12s %12s %12s %12s" % ("", "", "edges/s", "p50 us", "p99 us", "CPU us/edge", "signals/edge"))
+	for backendName, backend in backends:
+		for handlerName, handlerType, extraSettings in handlerTypes:
+			result = runBenchmark (digitalInputs, backend, handlerType, options.edges, options.inputs,
+					options.burst, extraSettings, options.gpiochip if backendName == "gpiod" else None)
+			print ("%-6s %-16s %12.0f %12.1f %12.1f %12.1f %12.2f" % (backendName, handlerName,
+					result['edgesPerSecond'], result['latency50'], result['latency99'],
+					result['cpuPerEdge'], result['signalsPerEdge']))
+
+if __name__ == "__main__":
+	main ()
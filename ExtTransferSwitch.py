@@ -20,6 +20,13 @@
 # For Quattro, the /Settings/TransferSwitch/TransferSwitchOnAc2 tells this program where the transfer switch is connected:
 #	0 if connected to AC 1 In
 #	1 if connected to AC 2 In
+#
+# Transfer switch state changes are normally processed as soon as the digital input service
+#	signals a change to it's /State (event-driven mode)
+#	the background timer then runs only as a slow watchdog
+# The --poll command line option restores the original behavior: /State is read every second
+#
+# Service overhead and transfer timing are published by com.victronenergy.exttransferswitch in /Stats/...
 
 import platform
 import argparse
@@ -33,6 +40,19 @@ import dbus
 dbusSettingsPath = "com.victronenergy.settings"
 dbusSystemPath = "com.victronenergy.system"
 
+# background timer intervals (milliseconds)
+pollInterval = 1000			# --poll mode: /State is read every tick
+watchdogInterval = 10000	# event-driven mode: signals do the work, timer only catches anything missed
+settingsFlushDelay = 2000	# saved settings are written this long after the first change so a flapping source
+							#	results in one batch of writes to localsettings (and flash), not one per transfer
+statsInterval = 60000		# tick statistics are collected every tick but only published this often
+
+# accommodate both Python 2 and 3
+# monotonic time is used for latency measurements so clock changes don't affect them
+try:
+	monotonicTime = time.monotonic
+except AttributeError:
+	monotonicTime = time.time
 
 
 # accommodate both Python 2 and 3
@@ -49,20 +69,202 @@ from vedbus import VeDbusService
 from ve_utils import wrap_dbus_value
 from settingsdevice import SettingsDevice
 
+# tracks the asynchronous writes made for one transfer
+#	all writes are issued at once and the transfer is complete when the last reply (or error) arrives
+#	so a transfer takes as long as the slowest write, not the sum of all of them
+# results holds (description, success, latency ms, error) for each write
+class TransferRecord:
+
+	def __init__ (self, name, startTime, completeCallback):
+		self.name = name
+		self.startTime = startTime
+		self.completeCallback = completeCallback
+		self.pending = {}
+		self.results = []
+		self.allIssued = False
+		self.endTime = None
+
+	def writeIssued (self, description):
+		self.pending[description] = monotonicTime ()
+
+	def writeDone (self, description, success, error=""):
+		now = monotonicTime ()
+		issueTime = self.pending.pop (description, now)
+		self.results.append ( (description, success, (now - issueTime) * 1000, error) )
+		self.checkComplete ()
+
+	# called after the last write has been issued
+	def issueComplete (self):
+		self.allIssued = True
+		self.checkComplete ()
+
+	def checkComplete (self):
+		if self.allIssued and len (self.pending) == 0 and self.endTime == None:
+			self.endTime = monotonicTime ()
+			self.completeCallback (self)
+
+	@property
+	def latency (self):
+		return (self.endTime - self.startTime) * 1000
+
+	@property
+	def failedWrites (self):
+		return [ result for result in self.results if not result[1] ]
+
+
 class Monitor:
 
+	# dbus proxy objects are cached so that the steady-state background tick
+	#	makes no get_object or introspection calls
+	# entries are discarded only when the owning service changes (NameOwnerChanged)
+	#	since a proxy is bound to the owner at the time it was created
+	def getProxy (self, service, path):
+		key = (service, path)
+		proxy = self.proxyCache.get (key)
+		if proxy == None:
+			self.dbusCalls += 1
+			proxy = self.theBus.get_object (service, path)
+			self.proxyCache[key] = proxy
+		return proxy
+
+	def nameOwnerChanged (self, name, oldOwner, newOwner):
+		for key in [ key for key in self.proxyCache if key[0] == name ]:
+			del self.proxyCache[key]
+		# a restarted service may be running different firmware
+		self.batchReadSupported.pop (name, None)
+
+		# force the objects that were built from this service to be rebuilt
+		#	and do that now rather than waiting for the watchdog tick
+		if name == dbusSystemPath:
+			self.vebusServiceText = None
+			self.background ()
+		# systemcalc may still report a VE.Bus service that has just gone away
+		#	so it is treated as missing until it (or another one) appears
+		elif name == self.veBusService:
+			self.veBusService = ""
+			self.vebusServiceText = "---" if newOwner == "" else None
+			self.background ()
+		elif name.startswith ("com.victronenergy.vebus") and newOwner != "" and self.veBusService == "":
+			self.vebusServiceText = None
+			self.background ()
+		elif name == dbusSettingsPath:
+			self.transferSwitchLocation = 0
+			self.background ()
+
+		# keep the digital input index up to date
+		#	a digital input whose type is changed is re-registered so this also catches
+		#	an input newly set to transfer switch
+		if name.startswith ("com.victronenergy.digitalinput"):
+			if oldOwner != "":
+				self.removeDigitalInput (name)
+			if newOwner != "":
+				self.addDigitalInput (name)
+			# act on a change to the transfer switch input immediately
+			if name == self.transferSwitchService or self.digitalInputStates.get (name) in (12, 13):
+				self.background ()
+
+	# local settings are written behind: saveSetting only records the new value
+	#	and flushSettings writes all changed keys together settingsFlushDelay later
+	# values that match what is already stored are not written at all
+	# getSetting must be used to read these settings so that unwritten values are seen
+	def getSetting (self, key):
+		if key in self.pendingSettings:
+			return self.pendingSettings[key]
+		elif key in self.settingsInFlight:
+			return self.settingsInFlight[key]
+		else:
+			return self.DbusSettings[key]
+
+	def saveSetting (self, key, value):
+		if value == self.getSetting (key):
+			self.settingsWritesSkipped += 1
+			return
+		self.pendingSettings[key] = value
+		if self.settingsFlushTimer == None:
+			self.settingsFlushTimer = GLib.timeout_add (settingsFlushDelay, self.flushSettings)
+
+	def flushSettings (self):
+		self.settingsFlushTimer = None
+		pendingSettings = self.pendingSettings
+		self.pendingSettings = {}
+		for key, value in pendingSettings.items ():
+			# may have been changed back to the stored value since it was saved
+			if key not in self.settingsInFlight and value == self.DbusSettings[key]:
+				self.settingsWritesSkipped += 1
+				continue
+			self.writeSettingAsync (key, value)
+		with self.statsService as stats:
+			stats['/Stats/SettingsWrites'] = self.settingsWrites
+			stats['/Stats/SettingsWritesSkipped'] = self.settingsWritesSkipped
+		return False
+
+	# the value is held in settingsInFlight until localsettings replies
+	#	by then SettingsDevice has seen the change signal and its cached value is current
+	def writeSettingAsync (self, key, value):
+		def replyHandler (result=0):
+			if result != 0:
+				errorHandler ("SetValue returned %s" % result)
+			elif self.settingsInFlight.get (key) == value:
+				del self.settingsInFlight[key]
+
+		def errorHandler (error):
+			logging.error ("dbus error setting %s not saved: %s" % (key, error))
+			self.failedWrites += 1
+			if self.settingsInFlight.get (key) == value:
+				del self.settingsInFlight[key]
+
+		self.settingsInFlight[key] = value
+		self.settingsWrites += 1
+		self.dbusCalls += 1
+		try:
+			self.getProxy (dbusSettingsPath, self.settingsPaths[key]).SetValue (wrap_dbus_value (value),
+					reply_handler=replyHandler, error_handler=errorHandler)
+		except Exception as error:
+			errorHandler (error)
+
+	# issue a SetValue without waiting for the reply so a slow service can't stall the main loop
+	#	if record is provided, the result and latency of the write are added to it
+	#	Victron services return 0 from SetValue on success
+	def setValueAsync (self, obj, value, description, record=None):
+		def replyHandler (result=0):
+			if result != 0:
+				errorHandler ("SetValue returned %s" % result)
+			elif record != None:
+				record.writeDone (description, True)
+
+		def errorHandler (error):
+			logging.error ("dbus error %s not changed: %s" % (description, error))
+			self.failedWrites += 1
+			if record != None:
+				record.writeDone (description, False, str (error))
+
+		if record != None:
+			record.writeIssued (description)
+		self.dbusCalls += 1
+		try:
+			obj.SetValue (value, reply_handler=replyHandler, error_handler=errorHandler)
+		except Exception as error:
+			errorHandler (error)
+
+	def vebusServiceChanged (self, changes):
+		# use the new text if provided, otherwise force a read on the next tick
+		self.vebusServiceText = changes.get ('Text')
+
+	# systemcalc publishes its changes with ItemsChanged on / only
+	#	so /VebusService changes are picked out of that signal
+	def systemItemsChanged (self, items):
+		if '/VebusService' in items:
+			self.vebusServiceChanged (items['/VebusService'])
+
 	def getVeBusObjects (self):
 		vebusService = ""
 
 		# invalidate all local parameters if transfer switch is not active
 		if not self.transferSwitchActive:
 			# release generator override if it's still active
-			try:
-				if self.remoteGeneratorSelectedItem != None:
-					self.remoteGeneratorSelectedItem.SetValue (wrap_dbus_value (0))
-			except:
-				logging.error ("could not release /Ac/Control/RemoteGeneratorSelected")
-				pass
+			if self.remoteGeneratorSelectedItem != None:
+				self.setValueAsync (self.remoteGeneratorSelectedItem, wrap_dbus_value (0),
+						"/Ac/Control/RemoteGeneratorSelected release")
 			self.remoteGeneratorSelectedItem = None
 			self.remoteGeneratorSelectedLocalValue = -1
 			self.dbusOk = False
@@ -75,8 +277,12 @@ class Monitor:
 			return
 
 		try:
-			obj = self.theBus.get_object (dbusSystemPath, '/VebusService')
-			vebusService = obj.GetText ()
+			# /VebusService is only read when it's not yet known or the system service changed
+			#	otherwise vebusServiceChanged () keeps the value up to date
+			if self.vebusServiceText == None:
+				self.dbusCalls += 1
+				self.vebusServiceText = self.getProxy (dbusSystemPath, '/VebusService').GetText ()
+			vebusService = self.vebusServiceText
 		except:
 			if self.dbusOk:
 				logging.info ("Multi/Quattro disappeared - /VebusService invalid")
@@ -94,11 +300,12 @@ class Monitor:
 		elif self.veBusService == "" or vebusService != self.veBusService:
 			self.veBusService = vebusService
 			try:
-				self.numberOfAcInputs = self.theBus.get_object (vebusService, "/Ac/NumberOfAcInputs").GetValue ()
+				self.dbusCalls += 1
+				self.numberOfAcInputs = self.getProxy (vebusService, "/Ac/NumberOfAcInputs").GetValue ()
 			except:
 				self.numberOfAcInputs = 0
 			try:
-				self.remoteGeneratorSelectedItem = self.theBus.get_object (vebusService,
+				self.remoteGeneratorSelectedItem = self.getProxy (vebusService,
 					"/Ac/Control/RemoteGeneratorSelected")
 			except:
 				self.remoteGeneratorSelectedItem = None
@@ -112,8 +319,8 @@ class Monitor:
 				logging.info ("discovered Multi at " + vebusService)			
 
 			try:
-				self.currentLimitObj = self.theBus.get_object (vebusService, "/Ac/ActiveIn/CurrentLimit")
-				self.currentLimitIsAdjustableObj = self.theBus.get_object (vebusService, "/Ac/ActiveIn/CurrentLimitIsAdjustable")
+				self.currentLimitObj = self.getProxy (vebusService, "/Ac/ActiveIn/CurrentLimit")
+				self.currentLimitIsAdjustableObj = self.getProxy (vebusService, "/Ac/ActiveIn/CurrentLimitIsAdjustable")
 			except:
 				logging.error ("current limit dbus setup failed - changes can't be made")
 				self.dbusOk = False
@@ -138,9 +345,9 @@ class Monitor:
 			self.stopWhenAcAvailableFpObj = None
 			try:
 				if self.transferSwitchLocation == 2:
-					self.acInputTypeObj = self.theBus.get_object (dbusSettingsPath, "/Settings/SystemSetup/AcInput2")
+					self.acInputTypeObj = self.getProxy (dbusSettingsPath, "/Settings/SystemSetup/AcInput2")
 				else:
-					self.acInputTypeObj = self.theBus.get_object (dbusSettingsPath, "/Settings/SystemSetup/AcInput1")
+					self.acInputTypeObj = self.getProxy (dbusSettingsPath, "/Settings/SystemSetup/AcInput1")
 				self.dbusOk = True
 			except:
 				self.dbusOk = False
@@ -151,164 +358,318 @@ class Monitor:
 			#	ignore errors if these aren't present
 			try:
 				if self.transferSwitchLocation == 2:
-					self.stopWhenAcAvailableObj = self.theBus.get_object (dbusSettingsPath, "/Settings/Generator0/StopWhenAc2Available")
+					self.stopWhenAcAvailableObj = self.getProxy (dbusSettingsPath, "/Settings/Generator0/StopWhenAc2Available")
 				else:
-					self.stopWhenAcAvailableObj = self.theBus.get_object (dbusSettingsPath, "/Settings/Generator0/StopWhenAc1Available")
+					self.stopWhenAcAvailableObj = self.getProxy (dbusSettingsPath, "/Settings/Generator0/StopWhenAc1Available")
 			except:
 				self.stopWhenAcAvailableObj = None
 			# first try new settings
 			try:
 				if self.transferSwitchLocation == 2:
-					self.stopWhenAcAvailableFpObj = self.theBus.get_object (dbusSettingsPath, "/Settings/Generator1/StopWhenAc2Available")
+					self.stopWhenAcAvailableFpObj = self.getProxy (dbusSettingsPath, "/Settings/Generator1/StopWhenAc2Available")
 				else:
-					self.stopWhenAcAvailableFpObj = self.theBus.get_object (dbusSettingsPath, "/Settings/Generator1/StopWhenAc1Available")
+					self.stopWhenAcAvailableFpObj = self.getProxy (dbusSettingsPath, "/Settings/Generator1/StopWhenAc1Available")
 			# next try old settings
 			except:
 				try:
 					if self.transferSwitchLocation == 2:
-						self.stopWhenAcAvailableFpObj = self.theBus.get_object (dbusSettingsPath, "/Settings/FischerPanda0/StopWhenAc2Available")
+						self.stopWhenAcAvailableFpObj = self.getProxy (dbusSettingsPath, "/Settings/FischerPanda0/StopWhenAc2Available")
 					else:
-						self.stopWhenAcAvailableFpObj = self.theBus.get_object (dbusSettingsPath, "/Settings/FischerPanda0/StopWhenAc1Available")
+						self.stopWhenAcAvailableFpObj = self.getProxy (dbusSettingsPath, "/Settings/FischerPanda0/StopWhenAc1Available")
 				except:
 					self.stopWhenAcAvailableFpObj = None
 
 
-	def updateTransferSwitchState (self):
-		inputInvalid = False
+	# digital input services are tracked in an index of service name and last known /State
+	#	the index is built by one scan at startup and then maintained from NameOwnerChanged
+	#	so there is no periodic list_names () scan to find the transfer switch input
+	# except in --poll mode, each digital input's /State change signals keep the index current
+	#	both the per-path PropertiesChanged and the newer root ItemsChanged are handled
+	#	processing the same value twice is harmless since only changes cause a transfer
+	def scanDigitalInputs (self):
+		self.dbusCalls += 1
+		for service in self.theBus.list_names ():
+			if service.startswith ("com.victronenergy.digitalinput"):
+				self.addDigitalInput (service)
+
+	# a /State that could not be read is stored as None and read again on the next background tick
+	def readDigitalInputState (self, service):
 		try:
-			if self.transferSwitchActive:
-				state = self.transferSwitchStateObj.GetValue ()
-				if state == 12:		# 12 is the on generator value
-					self.onGenerator = True
-				elif state == 13:	# 13 is the on grid value
-					self.onGenerator = False
-				# other value indicates the selected digital input is assigned to a different function
-				else:
-					inputInvalid = True
+			self.dbusCalls += 1
+			state = self.getProxy (service, '/State').GetValue ()
+		except:
+			state = None
+		self.digitalInputStates[service] = self.validState (state)
 
-			# digital input not active
-			# search for a new one only every 10 seconds to avoid unnecessary processing
-			elif self.tsInputSearchDelay >= 10:
-				newInputService = ""
-				for service in self.theBus.list_names():
-					# found a digital input service, now check the for valid state value
-					if service.startswith ("com.victronenergy.digitalinput"):
-						self.transferSwitchStateObj = self.theBus.get_object (service, '/State')
-						state = self.transferSwitchStateObj.GetValue()
-						# found it!
-						if state == 12 or state == 13:
-							newInputService = service
-							break
- 
-				# found new service - set up to use it's values
-				if newInputService != "":
-					logging.info ("discovered transfer switch digital input service at %s", newInputService)
-					self.transferSwitchActive = True
-				elif self.transferSwitchActive:
-					logging.info ("Transfer switch digital input service NOT found")
-					self.transferSwitchActive = False
+	# an invalid dbus value (empty array) is treated like a failed read
+	def validState (self, state):
+		if isinstance (state, (int, float)):
+			return state
+		return None
 
+	def addDigitalInput (self, service):
+		self.readDigitalInputState (service)
 
-		# any exception indicates the selected digital input is no longer active
+		if self.pollMode or service in self.digitalInputSignalMatches:
+			return
+		matches = []
+		try:
+			matches.append (self.theBus.add_signal_receiver (
+					lambda changes: self.digitalInputPropertiesChanged (service, changes),
+					dbus_interface='com.victronenergy.BusItem',
+					signal_name='PropertiesChanged', bus_name=service, path='/State'))
+			matches.append (self.theBus.add_signal_receiver (
+					lambda items: self.digitalInputItemsChanged (service, items),
+					dbus_interface='com.victronenergy.BusItem',
+					signal_name='ItemsChanged', bus_name=service, path='/'))
 		except:
-			inputInvalid = True
-
-		if inputInvalid:
-			if self.transferSwitchActive:
-				logging.info ("Transfer switch digital input no longer valid")
-			self.transferSwitchActive = False
+			logging.error ("could not subscribe to %s /State changes - relying on watchdog" % service)
+		self.digitalInputSignalMatches[service] = matches
 
+	def removeDigitalInput (self, service):
+		for match in self.digitalInputSignalMatches.pop (service, []):
+			try:
+				match.remove ()
+			except:
+				pass
+		self.digitalInputStates.pop (service, None)
+		self.itemsChangedServices.discard (service)
+
+	# services that send ItemsChanged also send /LastChangeTime with /State
+	#	so their PropertiesChanged signals are ignored
+	def digitalInputPropertiesChanged (self, service, changes):
+		if 'Value' in changes and service not in self.itemsChangedServices:
+			self.digitalInputStateChanged (service, changes['Value'])
+
+	def digitalInputItemsChanged (self, service, items):
+		self.itemsChangedServices.add (service)
+		if '/State' in items and 'Value' in items['/State']:
+			changeTime = items.get ('/LastChangeTime', {}).get ('Value')
+			self.digitalInputStateChanged (service, items['/State']['Value'], changeTime)
+
+	def digitalInputStateChanged (self, service, state, changeTime=None):
+		state = self.validState (state)
+		self.digitalInputStates[service] = state
 		if self.transferSwitchActive:
-			self.tsInputSearchDelay = 0
+			if service == self.transferSwitchService:
+				self.transferSwitchStateEvent (state, changeTime)
+		# an input was just set to transfer switch - start using it now
+		elif state == 12 or state == 13:
+			self.background ()
+
+	def transferSwitchStateEvent (self, state, changeTime=None):
+		if self.setTransferSwitchState (state, changeTime):
+			self.processTransferSwitch ()
+		# input assigned to a different function - let a full background pass clean up
 		else:
-			self.onGenerator = False
-			# if serch delay timer is active, increment it now
-			if self.tsInputSearchDelay < 10:
-				self.tsInputSearchDelay += 1
+			self.background ()
+
+	# updates onGenerator from a digital input /State value
+	# returns False if the value indicates the input is not a transfer switch
+	# changeTime is the monotonic time of the edge if the digital input service provided it
+	def setTransferSwitchState (self, state, changeTime=None):
+		if state == 12:		# 12 is the on generator value
+			onGenerator = True
+		elif state == 13:	# 13 is the on grid value
+			onGenerator = False
+		else:
+			return False
+
+		# remember when the change happened (or was first seen) for latency measurement
+		#	an edge time that doesn't make sense on this clock is ignored
+		if onGenerator != self.onGenerator:
+			now = monotonicTime ()
+			if changeTime != None and 0 <= now - changeTime < 60:
+				self.stateChangeTime = changeTime
 			else:
-				self.tsInputSearchDelay = 0
+				self.stateChangeTime = now
+		self.onGenerator = onGenerator
+		return True
 
 
-	def transferToGrid (self):
-		if self.dbusOk:
-			logging.info ("switching to grid settings")
-			# save current values for restore when switching back to generator
+	def updateTransferSwitchState (self):
+		inputInvalid = False
+		if self.transferSwitchActive:
+			# in event-driven mode this is only a watchdog read to catch any missed signal
 			try:
-				self.DbusSettings['generatorCurrentLimit'] = self.currentLimitObj.GetValue ()
+				self.dbusCalls += 1
+				state = self.validState (self.transferSwitchStateObj.GetValue ())
+				self.digitalInputStates[self.transferSwitchService] = state
+				# other value indicates the selected digital input is assigned to a different function
+				if not self.setTransferSwitchState (state):
+					inputInvalid = True
+			# any exception indicates the selected digital input is no longer active
 			except:
-				logging.error ("dbus error generator AC input current limit not saved switching to grid")
+				inputInvalid = True
+
+		if inputInvalid:
+			logging.info ("Transfer switch digital input no longer valid")
+			self.transferSwitchActive = False
+			self.transferSwitchService = ""
+			self.transferSwitchStateObj = None
 
+		# digital input not active - look for one in the index
+		#	only inputs whose /State could not be read are read again
+		if not self.transferSwitchActive:
+			for service in [ service for service, state in self.digitalInputStates.items () if state == None ]:
+				self.readDigitalInputState (service)
+			for service, state in self.digitalInputStates.items ():
+				# found it!
+				if state == 12 or state == 13:
+					logging.info ("discovered transfer switch digital input service at %s", service)
+					self.transferSwitchActive = True
+					self.transferSwitchService = service
+					self.transferSwitchStateObj = self.getProxy (service, '/State')
+					self.setTransferSwitchState (state)
+					break
+
+		if not self.transferSwitchActive:
+			self.onGenerator = False
+
+
+	# read several paths from one service in one round-trip
+	#	if all paths are in a small subtree, a GetValue on that subtree returns just that subtree
+	#	otherwise a GetItems call on the service root returns every value the service has
+	#		(more to serialise than one GetValue per path but only one call)
+	#	if the service can't do either, there is one GetValue per path
+	# returns a dictionary of path: value - paths that could not be read are None
+	def readSnapshot (self, service, paths, subtree=None):
+		values = {}
+		if self.batchReadSupported.get (service, True):
 			try:
-				self.acInputTypeObj.SetValue (self.DbusSettings['gridInputType'])
+				self.dbusCalls += 1
+				if subtree == None:
+					items = self.getProxy (service, '/').GetItems ()
+					for path in paths:
+						values[path] = items[path]['Value'] if path in items else None
+					return values
+				items = self.getProxy (service, subtree).GetValue ()
+				if isinstance (items, dict):
+					for path in paths:
+						values[path] = items.get (path[len (subtree) + 1:])
+					return values
+				logging.info ("%s can't read subtree %s - reading values individually" % (service, subtree))
+				self.batchReadSupported[service] = False
+			except dbus.exceptions.DBusException as e:
+				if e.get_dbus_name () in ('org.freedesktop.DBus.Error.UnknownMethod', 'org.freedesktop.DBus.Error.UnknownObject'):
+					logging.info ("%s can't read several values at once - reading values individually" % service)
+					self.batchReadSupported[service] = False
 			except:
-				logging.error ("dbus error AC input type not changed to grid")
+				pass
+
+		for path in paths:
 			try:
-				if self.currentLimitIsAdjustableObj.GetValue () == 1:
-					self.currentLimitObj.SetValue (wrap_dbus_value (self.DbusSettings['gridCurrentLimit']))
-				else:
-					logging.warning ("Input current limit not adjustable - not changed")
+				self.dbusCalls += 1
+				values[path] = self.getProxy (service, path).GetValue ()
 			except:
+				values[path] = None
+		return values
+
+	# read all values needed for a transfer: one call to the VE.Bus service for its /Ac/ActiveIn values
+	#	and one to settings - those are spread over the whole settings tree so GetItems is used
+	# returns the value for each object, None for missing objects and values that could not be read
+	def getTransferSnapshot (self):
+		vebusObjs = [ self.currentLimitObj, self.currentLimitIsAdjustableObj ]
+		settingsObjs = [ self.acInputTypeObj, self.stopWhenAcAvailableObj, self.stopWhenAcAvailableFpObj ]
+		values = self.readSnapshot (self.veBusService,
+				[ obj.object_path for obj in vebusObjs if obj != None ], subtree='/Ac/ActiveIn')
+		values.update (self.readSnapshot (dbusSettingsPath,
+				[ obj.object_path for obj in settingsObjs if obj != None ]))
+
+		snapshot = {}
+		for obj in vebusObjs + settingsObjs:
+			if obj != None:
+				snapshot[obj] = values.get (obj.object_path)
+		return snapshot
+
+
+	def transferToGrid (self):
+		if self.dbusOk:
+			logging.info ("switching to grid settings")
+			snapshot = self.getTransferSnapshot ()
+
+			# save current values for restore when switching back to generator
+			currentLimit = snapshot.get (self.currentLimitObj)
+			if currentLimit != None:
+				self.saveSetting ('generatorCurrentLimit', currentLimit)
+			else:
+				logging.error ("dbus error generator AC input current limit not saved switching to grid")
+
+			# all writes are issued together - the record tracks their completion
+			record = TransferRecord ("grid", self.stateChangeTime, self.transferComplete)
+			self.setValueAsync (self.acInputTypeObj, self.getSetting ('gridInputType'),
+					"AC input type", record)
+			currentLimitIsAdjustable = snapshot.get (self.currentLimitIsAdjustableObj)
+			if currentLimitIsAdjustable == 1:
+				self.setValueAsync (self.currentLimitObj, wrap_dbus_value (self.getSetting ('gridCurrentLimit')),
+						"AC input current limit", record)
+			elif currentLimitIsAdjustable != None:
+				logging.warning ("Input current limit not adjustable - not changed")
+			else:
 				logging.error ("dbus error AC input current limit not changed switching to grid")
 
-			try:
-				if self.stopWhenAcAvailableObj != None:
-					self.stopWhenAcAvailableObj.SetValue (self.DbusSettings['stopWhenAcAvaiable'])
-				if self.stopWhenAcAvailableFpObj != None:
-					self.stopWhenAcAvailableFpObj.SetValue (self.DbusSettings['stopWhenAcAvaiableFp'])
-			except:
-				logging.error ("stopWhenAcAvailable update not changed when switching to grid")
+			if self.stopWhenAcAvailableObj != None:
+				self.setValueAsync (self.stopWhenAcAvailableObj, self.getSetting ('stopWhenAcAvaiable'),
+						"stopWhenAcAvailable", record)
+			if self.stopWhenAcAvailableFpObj != None:
+				self.setValueAsync (self.stopWhenAcAvailableFpObj, self.getSetting ('stopWhenAcAvaiableFp'),
+						"stopWhenAcAvailable (Fp)", record)
+			record.issueComplete ()
 
 	def transferToGenerator (self):
 		if self.dbusOk:
 			logging.info ("switching to generator settings")
+			snapshot = self.getTransferSnapshot ()
+
 			# save current values for restore when switching back to grid
-			try:
-				self.DbusSettings['gridInputType'] = self.acInputTypeObj.GetValue ()
-			except:
+			acInputType = snapshot.get (self.acInputTypeObj)
+			if acInputType != None:
+				self.saveSetting ('gridInputType', acInputType)
+			else:
 				logging.error ("dbus error AC input type not saved when switching to generator")
-			try:
-				self.DbusSettings['gridCurrentLimit'] = self.currentLimitObj.GetValue ()
-			except:
+			currentLimit = snapshot.get (self.currentLimitObj)
+			if currentLimit != None:
+				self.saveSetting ('gridCurrentLimit', currentLimit)
+			else:
 				logging.error ("dbus error AC input current limit not saved when switching to generator")
-			try:
-				if self.stopWhenAcAvailableObj != None:
-					self.DbusSettings['stopWhenAcAvaiable'] = self.stopWhenAcAvailableObj.GetValue ()
-				else:
-					self.DbusSettings['stopWhenAcAvaiable'] = 0
-				if self.stopWhenAcAvailableFpObj != None:
-					self.DbusSettings['stopWhenAcAvaiableFp'] = self.stopWhenAcAvailableFpObj.GetValue ()
-				else:
-					self.DbusSettings['stopWhenAcAvaiableFp'] = 0
-			except:
+
+			if self.stopWhenAcAvailableObj != None:
+				stopWhenAcAvailable = snapshot.get (self.stopWhenAcAvailableObj)
+			else:
+				stopWhenAcAvailable = 0
+			if self.stopWhenAcAvailableFpObj != None:
+				stopWhenAcAvailableFp = snapshot.get (self.stopWhenAcAvailableFpObj)
+			else:
+				stopWhenAcAvailableFp = 0
+			if stopWhenAcAvailable != None:
+				self.saveSetting ('stopWhenAcAvaiable', stopWhenAcAvailable)
+			if stopWhenAcAvailableFp != None:
+				self.saveSetting ('stopWhenAcAvaiableFp', stopWhenAcAvailableFp)
+			if stopWhenAcAvailable == None or stopWhenAcAvailableFp == None:
 				logging.error ("dbus error stop when AC available settings not saved when switching to generator")
 
-			try:
-				self.acInputTypeObj.SetValue (2)
-			except:
-				logging.error ("dbus error AC input type not changed when switching to generator")
-			try:
-				if self.currentLimitIsAdjustableObj.GetValue () == 1:
-					self.currentLimitObj.SetValue (wrap_dbus_value (self.DbusSettings['generatorCurrentLimit']))
-				else:
-					logging.warning ("Input current limit not adjustable - not changed")
-			except:
+			# all writes are issued together - the record tracks their completion
+			record = TransferRecord ("generator", self.stateChangeTime, self.transferComplete)
+			self.setValueAsync (self.acInputTypeObj, 2, "AC input type", record)
+			currentLimitIsAdjustable = snapshot.get (self.currentLimitIsAdjustableObj)
+			if currentLimitIsAdjustable == 1:
+				self.setValueAsync (self.currentLimitObj, wrap_dbus_value (self.getSetting ('generatorCurrentLimit')),
+						"AC input current limit", record)
+			elif currentLimitIsAdjustable != None:
+				logging.warning ("Input current limit not adjustable - not changed")
+			else:
 				logging.error ("dbus error AC input current limit not changed when switching to generator")
 
-			try:
-				if self.stopWhenAcAvailableObj != None:
-					self.stopWhenAcAvailableObj.SetValue (0)
-				if self.stopWhenAcAvailableFpObj != None:
-					self.stopWhenAcAvailableFpObj.SetValue (0)
-			except:
-				logging.error ("stopWhenAcAvailable update not changed switching to generator")
-
+			if self.stopWhenAcAvailableObj != None:
+				self.setValueAsync (self.stopWhenAcAvailableObj, 0, "stopWhenAcAvailable", record)
+			if self.stopWhenAcAvailableFpObj != None:
+				self.setValueAsync (self.stopWhenAcAvailableFpObj, 0, "stopWhenAcAvailable (Fp)", record)
+			record.issueComplete ()
 
-	def background (self):
-
-		##startTime = time.time()
-		self.updateTransferSwitchState ()
-		self.getVeBusObjects ()
 
+	# act on a transfer switch state change and keep RemoteGeneratorSelected in sync
+	# called from the background tick and directly from the /State change signal handlers
+	def processTransferSwitch (self):
 		# skip processing if any dbus paramters were not initialized properly
 		if self.dbusOk and self.transferSwitchActive:
 
@@ -331,22 +692,116 @@ class Monitor:
 		if self.remoteGeneratorSelectedItem == None:
 			self.remoteGeneratorSelectedLocalValue = -1
 		elif newRemoteGeneratorSelectedLocalValue != self.remoteGeneratorSelectedLocalValue:
-			try:
-				self.remoteGeneratorSelectedItem.SetValue (wrap_dbus_value (newRemoteGeneratorSelectedLocalValue))
-			except:
-				logging.error ("could not set /Ac/Control/RemoteGeneratorSelected")
-				pass
-
+			self.setValueAsync (self.remoteGeneratorSelectedItem, wrap_dbus_value (newRemoteGeneratorSelectedLocalValue),
+					"/Ac/Control/RemoteGeneratorSelected")
 			self.remoteGeneratorSelectedLocalValue = newRemoteGeneratorSelectedLocalValue
 
-		##stopTime = time.time()
-		##print ("#### background time %0.3f" % (stopTime - startTime))
+
+	# called when the last write of a transfer has completed
+	# reports time from seeing the state change to the new settings being applied
+	#	and the outcome and latency of each write
+	# in --poll mode the edge may have occurred up to a full poll interval before it was seen
+	def transferComplete (self, record):
+		self.transferCount += 1
+		with self.statsService as stats:
+			stats['/Stats/LastTransferLatency'] = round (record.latency, 1)
+			stats['/Stats/TransferCount'] = self.transferCount
+			stats['/Stats/FailedWrites'] = self.failedWrites
+
+		writes = ", ".join ([ "%s %s %0.1f ms" % (description, "ok" if success else "FAILED", latency)
+				for description, success, latency, error in record.results ])
+		if self.pollMode:
+			logging.info ("transfer to %s complete %0.1f ms after state change was seen (plus up to %d ms poll delay): %s"
+					% (record.name, record.latency, pollInterval, writes))
+		else:
+			logging.info ("transfer to %s complete %0.1f ms after state change: %s"
+					% (record.name, record.latency, writes))
+
+
+	def background (self):
+
+		startTime = monotonicTime ()
+		startCalls = self.dbusCalls
+		self.updateTransferSwitchState ()
+		self.getVeBusObjects ()
+		self.processTransferSwitch ()
+
+		self.updateTickStats ((monotonicTime () - startTime) * 1000, self.dbusCalls - startCalls)
 		return True
 
 
-	def __init__(self):
+	# publish this service's overhead so it can be graphed without a debugger
+	# the name is only registered once all paths are there (register=False)
+	#	older velib without that option registers it straight away
+	def createStatsService (self):
+		try:
+			self.statsService = VeDbusService ("com.victronenergy.exttransferswitch", bus=self.theBus, register=False)
+			registerLater = True
+		except TypeError:
+			self.statsService = VeDbusService ("com.victronenergy.exttransferswitch", bus=self.theBus)
+			registerLater = False
+		self.statsService.add_path ('/Mgmt/ProcessName', __file__)
+		self.statsService.add_path ('/Mgmt/ProcessVersion', self.installedVersion)
+		self.statsService.add_path ('/Mgmt/Connection', "local")
+		self.statsService.add_path ('/DeviceInstance', 0)
+		self.statsService.add_path ('/ProductId', 0xFFFF)
+		self.statsService.add_path ('/ProductName', "External transfer switch")
+		self.statsService.add_path ('/Connected', 1)
+
+		msText = lambda path, value: "%0.1f ms" % value
+		self.statsService.add_path ('/Stats/TickDuration/Last', 0.0, gettextcallback=msText)
+		self.statsService.add_path ('/Stats/TickDuration/Avg', 0.0, gettextcallback=msText)
+		self.statsService.add_path ('/Stats/TickDuration/Max', 0.0, gettextcallback=msText)
+		self.statsService.add_path ('/Stats/DbusCallsPerTick', 0)
+		self.statsService.add_path ('/Stats/DbusCalls', 0)
+		self.statsService.add_path ('/Stats/LastTransferLatency', None, gettextcallback=msText)
+		self.statsService.add_path ('/Stats/TransferCount', 0)
+		self.statsService.add_path ('/Stats/FailedWrites', 0)
+		self.statsService.add_path ('/Stats/SettingsWrites', 0)
+		self.statsService.add_path ('/Stats/SettingsWritesSkipped', 0)
+		if registerLater:
+			self.statsService.register ()
+
+	# tick statistics are only collected here - publishTickStats puts them on dbus
+	#	so the watchdog tick doesn't send a signal every time it runs
+	def updateTickStats (self, duration, dbusCalls):
+		self.tickCount += 1
+		self.tickDurationTotal += duration
+		self.tickDurationMax = max (self.tickDurationMax, duration)
+		self.tickDurationLast = duration
+		self.tickDbusCalls = dbusCalls
+
+	def publishTickStats (self):
+		if self.tickCount == 0:
+			return True
+		with self.statsService as stats:
+			stats['/Stats/TickDuration/Last'] = round (self.tickDurationLast, 1)
+			stats['/Stats/TickDuration/Avg'] = round (self.tickDurationTotal / self.tickCount, 1)
+			stats['/Stats/TickDuration/Max'] = round (self.tickDurationMax, 1)
+			stats['/Stats/DbusCallsPerTick'] = self.tickDbusCalls
+			stats['/Stats/DbusCalls'] = self.dbusCalls
+			stats['/Stats/FailedWrites'] = self.failedWrites
+		return True
+
+
+	def __init__(self, pollMode=False, installedVersion=""):
 
 		self.theBus = dbus.SystemBus()
+		self.pollMode = pollMode
+		self.installedVersion = installedVersion
+
+		# statistics published on /Stats/...
+		self.dbusCalls = 0
+		self.failedWrites = 0
+		self.transferCount = 0
+		self.tickCount = 0
+		self.tickDurationTotal = 0.0
+		self.tickDurationMax = 0.0
+		self.tickDurationLast = 0.0
+		self.tickDbusCalls = 0
+		self.settingsWrites = 0
+		self.settingsWritesSkipped = 0
+		self.createStatsService ()
 		self.onGenerator = False
 		self.veBusService = ""
 		self.lastVeBusService = ""
@@ -366,7 +821,17 @@ class Monitor:
 		self.transferSwitchActive = False
 		self.dbusOk = False
 		self.transferSwitchLocation = 0
-		self.tsInputSearchDelay = 99 # allow serch to occur immediately
+		self.transferSwitchService = ""
+		self.digitalInputStates = {}
+		self.digitalInputSignalMatches = {}
+		self.itemsChangedServices = set ()
+		self.proxyCache = {}
+		self.batchReadSupported = {}
+		self.vebusServiceText = None
+		self.stateChangeTime = monotonicTime ()
+		self.pendingSettings = {}
+		self.settingsInFlight = {}
+		self.settingsFlushTimer = None
 
 		# create / attach local settings
 		settingsList = {
@@ -377,16 +842,45 @@ class Monitor:
 			'stopWhenAcAvaiableFp': [ '/Settings/TransferSwitch/StopWhenAcAvailableFp', 0, 0, 0 ],
 			'transferSwitchOnAc2': [ '/Settings/TransferSwitch/TransferSwitchOnAc2', 0, 0, 0 ],
 						}
+		self.settingsPaths = dict ((key, setting[0]) for key, setting in settingsList.items ())
 		self.DbusSettings = SettingsDevice(bus=self.theBus, supportedSettings=settingsList,
 								timeout = 10, eventCallback=None )
 
-		GLib.timeout_add (1000, self.background)
+		# invalidate cached proxies when a service comes or goes
+		#	and track changes to the main VE.Bus service without polling it
+		self.theBus.add_signal_receiver (self.nameOwnerChanged, signal_name='NameOwnerChanged',
+				dbus_interface='org.freedesktop.DBus')
+		self.theBus.add_signal_receiver (self.vebusServiceChanged, signal_name='PropertiesChanged',
+				dbus_interface='com.victronenergy.BusItem', bus_name=dbusSystemPath, path='/VebusService')
+		self.theBus.add_signal_receiver (self.systemItemsChanged, signal_name='ItemsChanged',
+				dbus_interface='com.victronenergy.BusItem', bus_name=dbusSystemPath, path='/')
+
+		# one-time scan for digital inputs - NameOwnerChanged handles them from here on
+		self.scanDigitalInputs ()
+		# process the initial state now rather than waiting for the first background tick
+		self.background ()
+
+		# in --poll mode the background tick does all the work
+		# otherwise the /State change signals do and the tick is a slow watchdog
+		if self.pollMode:
+			backgroundInterval = pollInterval
+			logging.info ("polling transfer switch state every %d ms" % pollInterval)
+		else:
+			backgroundInterval = watchdogInterval
+		GLib.timeout_add (backgroundInterval, self.background)
+		self.publishTickStats ()
+		GLib.timeout_add (statsInterval, self.publishTickStats)
 		return None
 
 def main():
 
 	from dbus.mainloop.glib import DBusGMainLoop
 
+	parser = argparse.ArgumentParser (description="External AC input transfer switch service")
+	parser.add_argument ('--poll', action='store_true',
+		help="poll the transfer switch state every second instead of using change signals")
+	args = parser.parse_args ()
+
 	# set logging level to include info level entries
 	logging.basicConfig(level=logging.INFO)
 
@@ -412,9 +906,10 @@ def main():
 
 	logging.info (">>>>>>>>>>>>>>>> ExtTransferSwitch starting " + installedVersion + " <<<<<<<<<<<<<<<<")
 
-	Monitor ()
+	Monitor (pollMode=args.poll, installedVersion=installedVersion)
 
 	mainloop = GLib.MainLoop()
 	mainloop.run()
 
-main()
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+
+# Offline simulation harness for ExtTransferSwitch.py
+#
+# Runs the Monitor class against an in-process stand-in for the Venus OS dbus:
+#	fake settings, system, VE.Bus and digital input services
+#	a fake GLib main loop running on a virtual clock so scenarios run at accelerated time
+#
+# Scenarios replay grid/generator edges, services disappearing and reappearing
+#	Quattro AC 2 configuration changes and a digital input whose /State can't be read at first
+# For each scenario and mode (event-driven and --poll) the harness reports:
+#	the number of dbus calls made by the Monitor
+#	transfer latency from the digital input edge to the last setting applied
+#	the final settings state
+#
+# No dbus, GLib or velib_python is needed - the fakes are installed in place of those modules
+#	before ExtTransferSwitch is imported
+#
+# usage: ExtTransferSwitchSim.py [--scenario name] [--latency ms] [--vebus-latency ms] [--no-batch] [--item-cost us] [--verbose]
+
+import argparse
+import heapq
+import logging
+import os
+import sys
+import types
+
+
+# virtual time main loop - replaces GLib
+#	timers run in virtual time order and the clock jumps from one event to the next
+class SimLoop:
+
+	def __init__ (self):
+		self.now = 0.0
+		self.queue = []
+		self.sequence = 0
+		self.removed = set ()
+
+	def monotonic (self):
+		return self.now
+
+	def advance (self, seconds):
+		self.now += seconds
+
+	def schedule (self, delay, callback, args=(), interval=None):
+		self.sequence += 1
+		heapq.heappush (self.queue, (self.now + delay, self.sequence, self.sequence, callback, args, interval))
+		return self.sequence
+
+	# GLib API used by ExtTransferSwitch
+	def timeout_add (self, milliseconds, callback, *args):
+		return self.schedule (milliseconds / 1000.0, callback, args, interval=milliseconds / 1000.0)
+
+	def idle_add (self, callback, *args):
+		return self.schedule (0, callback, args, interval=0)
+
+	def source_remove (self, sourceId):
+		self.removed.add (sourceId)
+
+	def runUntil (self, endTime):
+		while self.queue and self.queue[0][0] <= endTime:
+			when, sequence, sourceId, callback, args, interval = heapq.heappop (self.queue)
+			if sourceId in self.removed:
+				continue
+			# a blocking call may have moved the clock past this event already
+			self.now = max (self.now, when)
+			result = callback (*args)
+			# GLib sources repeat while the callback returns True
+			if interval != None and result:
+				heapq.heappush (self.queue, (self.now + interval, sequence, sourceId, callback, args, interval))
+		self.now = max (self.now, endTime)
+
+
+class DBusException (Exception):
+
+	def __init__ (self, message, name="org.freedesktop.DBus.Error.Failed"):
+		Exception.__init__ (self, message)
+		self.name = name
+
+	def get_dbus_name (self):
+		return self.name
+
+
+# one service on the fake bus: a dictionary of path: value
+class SimService:
+
+	def __init__ (self, name, items, supportsBatch=True, latency=None, failedReads=0):
+		self.name = name
+		self.items = dict (items)
+		self.supportsBatch = supportsBatch
+		self.failedReads = failedReads
+		self.latency = latency
+
+
+class SimMatch:
+
+	def __init__ (self, bus, handler, signalName, busName, path):
+		self.bus = bus
+		self.handler = handler
+		self.signalName = signalName
+		self.busName = busName
+		self.path = path
+
+	def remove (self):
+		if self in self.bus.receivers:
+			self.bus.receivers.remove (self)
+
+
+# proxy object returned by get_object
+#	synchronous calls block (advance the virtual clock) for the service latency
+#	SetValue with reply/error handlers is answered later by the loop
+class SimProxy:
+
+	def __init__ (self, bus, service, path):
+		self.bus = bus
+		self.service = service
+		self.object_path = path
+
+	def _service (self):
+		service = self.bus.services.get (self.service)
+		if service == None or service is not self.bus.owners.get (self.service):
+			raise DBusException ("%s has no owner" % self.service, "org.freedesktop.DBus.Error.ServiceUnknown")
+		return service
+
+	def _value (self, service):
+		if self.object_path not in service.items:
+			raise DBusException ("no %s on %s" % (self.object_path, self.service), "org.freedesktop.DBus.Error.UnknownObject")
+		return service.items[self.object_path]
+
+	# GetValue on a subtree returns a dictionary of all values below it, keyed by the relative path
+	#	serialising them costs the per item time for each value
+	def GetValue (self):
+		service = self._service ()
+		# a service that is still starting up may not answer the first reads
+		if service.failedReads > 0:
+			service.failedReads -= 1
+			self.bus.blockingCall ('GetValue', service)
+			raise DBusException ("no reply from %s" % self.service, "org.freedesktop.DBus.Error.NoReply")
+		if self.object_path in service.items or not service.supportsBatch:
+			self.bus.blockingCall ('GetValue', service)
+			return self._value (service)
+		prefix = self.object_path.rstrip ('/') + '/'
+		values = dict ((path[len (prefix):], value) for path, value in service.items.items () if path.startswith (prefix))
+		self.bus.blockingCall ('GetValue', service, len (values))
+		if len (values) == 0:
+			return self._value (service)
+		return values
+
+	def GetItems (self):
+		service = self._service ()
+		if not service.supportsBatch:
+			raise DBusException ("GetItems", "org.freedesktop.DBus.Error.UnknownMethod")
+		self.bus.blockingCall ('GetItems', service, len (service.items))
+		return dict ((path, { 'Value': value, 'Text': str (value) }) for path, value in service.items.items ())
+
+	def GetText (self):
+		service = self._service ()
+		self.bus.blockingCall ('GetText', service)
+		value = self._value (service)
+		return "---" if value == None or value == "" else str (value)
+
+	def SetValue (self, value, reply_handler=None, error_handler=None):
+		try:
+			service = self._service ()
+			self._value (service)
+		except DBusException as error:
+			if error_handler == None:
+				raise
+			self.bus.countCall ('SetValue')
+			self.bus.loop.schedule (self.bus.latencyFor (service=None), error_handler, (error,))
+			return
+		if reply_handler == None:
+			self.bus.blockingCall ('SetValue', service)
+			self.bus.setValue (self.service, self.object_path, value)
+			return 0
+		# asynchronous - the value is applied and the reply is sent after the service latency
+		self.bus.countCall ('SetValue')
+		def reply ():
+			self.bus.setValue (self.service, self.object_path, value)
+			reply_handler (0)
+		self.bus.loop.schedule (self.bus.latencyFor (service), reply)
+
+
+# the fake system bus
+class SimBus:
+
+	def __init__ (self, loop, latency, itemCost=0.0):
+		self.loop = loop
+		self.latency = latency
+		self.itemCost = itemCost
+		self.services = {}
+		self.owners = {}
+		self.receivers = []
+		self.calls = {}
+
+	def latencyFor (self, service):
+		if service != None and service.latency != None:
+			return service.latency
+		return self.latency
+
+	def countCall (self, method):
+		self.calls[method] = self.calls.get (method, 0) + 1
+
+	def blockingCall (self, method, service, items=1):
+		self.countCall (method)
+		self.loop.advance (self.latencyFor (service) + items * self.itemCost)
+
+	# service management (scenario side)
+	def addService (self, service):
+		self.services[service.name] = service
+		self.owners[service.name] = service
+		self.emit ('org.freedesktop.DBus', '/org/freedesktop/DBus', 'NameOwnerChanged',
+				(service.name, "", ":1.%d" % id (service)))
+
+	def removeService (self, name):
+		service = self.owners.pop (name, None)
+		if service != None:
+			self.emit ('org.freedesktop.DBus', '/org/freedesktop/DBus', 'NameOwnerChanged',
+					(name, ":1.%d" % id (service), ""))
+
+	def setValue (self, serviceName, path, value):
+		service = self.services[serviceName]
+		if service.items.get (path) == value:
+			return
+		service.items[path] = value
+		changes = { 'Value': value, 'Text': "---" if value == None or value == "" else str (value) }
+		self.emit (serviceName, path, 'PropertiesChanged', (changes,))
+		self.emit (serviceName, '/', 'ItemsChanged', ({ path: changes },))
+
+	# signals are delivered by the loop, not from inside the call that caused them
+	def emit (self, serviceName, path, signalName, args):
+		for match in list (self.receivers):
+			if match.signalName != signalName:
+				continue
+			if match.busName != None and match.busName != serviceName:
+				continue
+			if match.path != None and match.path != path:
+				continue
+			self.loop.schedule (0, match.handler, args)
+
+	# dbus-python API used by ExtTransferSwitch
+	def list_names (self):
+		self.countCall ('ListNames')
+		return list (self.owners.keys ())
+
+	def get_object (self, service, path):
+		self.countCall ('get_object')
+		if service not in self.owners:
+			raise DBusException ("%s has no owner" % service, "org.freedesktop.DBus.Error.NameHasNoOwner")
+		return SimProxy (self, service, path)
+
+	def add_signal_receiver (self, handler, signal_name=None, dbus_interface=None, bus_name=None, path=None):
+		self.countCall ('AddMatch')
+		match = SimMatch (self, handler, signal_name, bus_name, path)
+		self.receivers.append (match)
+		return match
+
+
+# stand-in for velib_python's VeDbusService - a local dictionary of path values
+class SimVeDbusService:
+
+	def __init__ (self, servicename, bus=None, register=True):
+		self.name = servicename
+		self.items = {}
+		self.registered = register
+
+	def register (self):
+		self.registered = True
+
+	def add_path (self, path, value, description="", writeable=False, onchangecallback=None, gettextcallback=None):
+		self.items[path] = value
+
+	def __getitem__ (self, path):
+		return self.items[path]
+
+	def __setitem__ (self, path, value):
+		self.items[path] = value
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, *exc):
+		pass
+
+
+# stand-in for velib_python's SettingsDevice - settings live on the fake settings service
+#	reads are local, writes are SetValue calls like the real thing
+class SimSettingsDevice:
+
+	def __init__ (self, bus, supportedSettings, eventCallback, name='com.victronenergy.settings', timeout=0):
+		self.bus = bus
+		self.service = name
+		self.paths = {}
+		for key, setting in supportedSettings.items ():
+			self.paths[key] = setting[0]
+			self.bus.services[name].items.setdefault (setting[0], setting[1])
+
+	def __getitem__ (self, key):
+		return self.bus.services[self.service].items[self.paths[key]]
+
+	def __setitem__ (self, key, value):
+		self.bus.blockingCall ('SetValue', self.bus.services[self.service])
+		self.bus.setValue (self.service, self.paths[key], value)
+
+
+# install the fakes in place of dbus, GLib and velib_python, then import the service
+def importExtTransferSwitch ():
+	simulation = sys.modules[__name__]
+
+	dbusModule = types.ModuleType ('dbus')
+	dbusModule.SystemBus = lambda: simulation.currentBus
+	dbusModule.exceptions = types.ModuleType ('dbus.exceptions')
+	dbusModule.exceptions.DBusException = DBusException
+	sys.modules['dbus'] = dbusModule
+	sys.modules['dbus.exceptions'] = dbusModule.exceptions
+
+	gi = types.ModuleType ('gi')
+	gi.repository = types.ModuleType ('gi.repository')
+	gi.repository.GLib = SimLoop ()
+	sys.modules['gi'] = gi
+	sys.modules['gi.repository'] = gi.repository
+
+	vedbus = types.ModuleType ('vedbus')
+	vedbus.VeDbusService = SimVeDbusService
+	sys.modules['vedbus'] = vedbus
+	veUtils = types.ModuleType ('ve_utils')
+	veUtils.wrap_dbus_value = lambda value: value
+	sys.modules['ve_utils'] = veUtils
+	settingsdevice = types.ModuleType ('settingsdevice')
+	settingsdevice.SettingsDevice = SimSettingsDevice
+	sys.modules['settingsdevice'] = settingsdevice
+
+	sys.path.insert (0, os.path.dirname (os.path.abspath (__file__)))
+	import ExtTransferSwitch
+	return ExtTransferSwitch
+
+currentBus = None
+
+
+VEBUS = "com.victronenergy.vebus.ttyS4"
+DIGITAL_INPUT = "com.victronenergy.digitalinput.input01"
+SETTINGS = "com.victronenergy.settings"
+SYSTEM = "com.victronenergy.system"
+ON_GENERATOR = 12
+ON_GRID = 13
+
+# the services are padded to roughly the size of the real ones
+#	so reading more than is needed shows up in the latency
+PADDING = '/Padding'
+
+def padding (prefix, count):
+	return dict (("%s%s/Item%d" % (prefix, PADDING, index), 0) for index in range (count))
+
+def settingsService ():
+	return SimService (SETTINGS, dict (padding ('/Settings', 600), **{
+		'/Settings/SystemSetup/AcInput1': 1,
+		'/Settings/SystemSetup/AcInput2': 0,
+		'/Settings/Generator0/StopWhenAc1Available': 1,
+		'/Settings/Generator0/StopWhenAc2Available': 0,
+		'/Settings/Generator1/StopWhenAc1Available': 0,
+		'/Settings/Generator1/StopWhenAc2Available': 0,
+		'/Settings/TransferSwitch/GridCurrentLimit': 30.0,
+		'/Settings/TransferSwitch/GeneratorCurrentLimit': 16.0,
+		}))
+
+def systemService ():
+	return SimService (SYSTEM, dict (padding ('', 200), **{ '/VebusService': VEBUS }))
+
+def vebusService (numberOfAcInputs=1):
+	return SimService (VEBUS, dict (padding ('/Ac/Out', 40), **dict (padding ('', 200), **{
+		'/Ac/NumberOfAcInputs': numberOfAcInputs,
+		'/Ac/ActiveIn/CurrentLimit': 30.0,
+		'/Ac/ActiveIn/CurrentLimitIsAdjustable': 1,
+		'/Ac/Control/RemoteGeneratorSelected': 0,
+		})))
+
+def digitalInputService (state=ON_GRID, failedReads=0):
+	return SimService (DIGITAL_INPUT, { '/State': state, '/Type': 12 }, failedReads=failedReads)
+
+
+# scenario actions - each takes the bus and returns a short description for verbose output
+def edge (state):
+	def action (bus):
+		bus.setValue (DIGITAL_INPUT, '/State', state)
+	action.edge = True
+	action.__name__ = "on generator" if state == ON_GENERATOR else "on grid"
+	return action
+
+def removeService (name):
+	def action (bus):
+		bus.removeService (name)
+	action.__name__ = "remove " + name
+	return action
+
+def addService (factory, *args):
+	def action (bus):
+		bus.addService (factory (*args))
+	action.__name__ = "add " + factory.__name__
+	return action
+
+def setValue (service, path, value):
+	def action (bus):
+		bus.setValue (service, path, value)
+	action.__name__ = "%s %s = %s" % (service, path, value)
+	return action
+
+# each scenario is a list of (time in seconds, action) and a run length
+scenarios = {
+	'flip': ([
+		(5.3, edge (ON_GENERATOR)),
+		(65.7, edge (ON_GRID)),
+		(125.1, edge (ON_GENERATOR)),
+		(185.9, edge (ON_GRID)),
+		], 240),
+	'chatter': ([ (10.0 + i * 0.3, edge (ON_GENERATOR if i % 2 == 0 else ON_GRID)) for i in range (16) ], 60),
+	'restart': ([
+		(5.2, edge (ON_GENERATOR)),
+		(30.0, removeService (DIGITAL_INPUT)),
+		(35.0, addService (digitalInputService, ON_GRID)),
+		(60.0, removeService (VEBUS)),
+		(62.0, setValue (SYSTEM, '/VebusService', "")),
+		(65.0, addService (vebusService)),
+		(65.5, setValue (SYSTEM, '/VebusService', VEBUS)),
+		(90.4, edge (ON_GENERATOR)),
+		(120.6, edge (ON_GRID)),
+		], 150),
+	'quattro': ([
+		(5.0, removeService (VEBUS)),
+		(6.0, addService (vebusService, 2)),
+		(7.0, setValue (SETTINGS, '/Settings/TransferSwitch/TransferSwitchOnAc2', 1)),
+		(40.3, edge (ON_GENERATOR)),
+		(80.8, edge (ON_GRID)),
+		], 120),
+	# the input comes back already on generator but its /State can't be read at first
+	#	the watchdog must read it again - there is no edge to signal it
+	'unreadable': ([
+		(5.0, removeService (DIGITAL_INPUT)),
+		(6.0, addService (digitalInputService, ON_GENERATOR, 1)),
+		], 30),
+	}
+
+
+def runScenario (ExtTransferSwitch, name, pollMode, options):
+	global currentBus
+	actions, runLength = scenarios[name]
+
+	loop = SimLoop ()
+	bus = SimBus (loop, options.latency / 1000.0, options.itemCost / 1000000.0)
+	currentBus = bus
+	ExtTransferSwitch.GLib = loop
+	ExtTransferSwitch.monotonicTime = loop.monotonic
+
+	bus.addService (settingsService ())
+	bus.addService (systemService ())
+	vebus = vebusService ()
+	bus.addService (vebus)
+	bus.addService (digitalInputService ())
+	for service in bus.services.values ():
+		service.supportsBatch = not options.noBatch
+	if options.vebusLatency != None:
+		vebus.latency = options.vebusLatency / 1000.0
+	bus.calls = {}
+
+	# latency is measured from the actual edge, not from when the Monitor saw it
+	#	only the first transfer after an edge is attributed to it
+	#	transfers caused by anything else (services restarting) are counted separately
+	edge = { 'time': None, 'otherTransfers': 0 }
+	latencies = []
+	def transferComplete (record):
+		if edge['time'] != None:
+			latencies.append ((record.endTime - edge['time']) * 1000)
+			edge['time'] = None
+		else:
+			edge['otherTransfers'] += 1
+		originalTransferComplete (record)
+
+	monitor = ExtTransferSwitch.Monitor (pollMode=pollMode)
+	originalTransferComplete = monitor.transferComplete
+	monitor.transferComplete = transferComplete
+
+	for when, action in sorted (actions, key=lambda entry: entry[0]):
+		loop.runUntil (when)
+		if options.verbose:
+			logging.info ("%8.3f s: %s" % (loop.now, action.__name__))
+		if getattr (action, 'edge', False) and edge['time'] == None:
+			edge['time'] = loop.now
+		action (bus)
+	loop.runUntil (runLength)
+
+	return {
+		'calls': dict (bus.calls),
+		'latencies': latencies,
+		'otherTransfers': edge['otherTransfers'],
+		'stats': dict ((path, value) for path, value in monitor.statsService.items.items () if path.startswith ('/Stats')),
+		'settings': dict (bus.services[SETTINGS].items),
+		'vebus': dict (bus.services[VEBUS].items),
+		'runLength': runLength,
+		}
+
+
+def report (name, mode, result):
+	calls = result['calls']
+	print ("%s (%s) %d s simulated" % (name, mode, result['runLength']))
+	print ("  dbus calls: %d  %s" % (sum (calls.values ()),
+			", ".join ([ "%s %d" % (method, count) for method, count in sorted (calls.items ()) ])))
+	latencies = result['latencies']
+	if latencies:
+		print ("  transfers after an edge: %d  edge to applied: avg %0.1f ms  max %0.1f ms"
+				% (len (latencies), sum (latencies) / len (latencies), max (latencies)))
+	else:
+		print ("  transfers after an edge: 0")
+	print ("  other transfers: %d" % result['otherTransfers'])
+	print ("  failed writes: %d" % result['stats'].get ('/Stats/FailedWrites', 0))
+	print ("  settings writes: %d  skipped: %d" % (result['stats'].get ('/Stats/SettingsWrites', 0),
+			result['stats'].get ('/Stats/SettingsWritesSkipped', 0)))
+	print ("  final settings:")
+	for path, value in sorted (result['settings'].items ()):
+		if PADDING in path:
+			continue
+		print ("    %-50s %s" % (path, value))
+	print ("    %-50s %s" % ("vebus /Ac/ActiveIn/CurrentLimit", result['vebus']['/Ac/ActiveIn/CurrentLimit']))
+
+
+def main ():
+	parser = argparse.ArgumentParser (description="Run ExtTransferSwitch against a simulated dbus")
+	parser.add_argument ('--scenario', choices=sorted (scenarios.keys ()), action='append',
+			help="scenario to run (may be repeated), default is all")
+	parser.add_argument ('--latency', type=float, default=2.0, help="dbus call latency in ms (default 2)")
+	parser.add_argument ('--vebus-latency', dest='vebusLatency', type=float, default=None,
+			help="VE.Bus service call latency in ms (default same as --latency)")
+	parser.add_argument ('--no-batch', dest='noBatch', action='store_true',
+			help="simulate older firmware without GetItems or GetValue on a subtree")
+	parser.add_argument ('--item-cost', dest='itemCost', type=float, default=20.0,
+			help="time to serialise each value a call returns in us (default 20)")
+	parser.add_argument ('--verbose', action='store_true', help="show ExtTransferSwitch log output")
+	options = parser.parse_args ()
+
+	logging.basicConfig (level=logging.INFO if options.verbose else logging.WARNING)
+
+	ExtTransferSwitch = importExtTransferSwitch ()
+	for name in options.scenario or sorted (scenarios.keys ()):
+		for pollMode in (True, False):
+			result = runScenario (ExtTransferSwitch, name, pollMode, options)
+			report (name, "poll" if pollMode else "event-driven", result)
+			print ("")
+
+if __name__ == "__main__":
+	main ()
@@ -143,5 +143,33 @@ MbPage {
 			]
 			visible: root.isTransferSwitch && root.showTransferSwitchConnection
 		}
+
+//// added for ExtTransferSwitch package
+		MbSpinBox
+		{
+			description: qsTr("Debounce time (0 = off)")
+			item
+			{
+				bind: Utils.path (root.settingsBindPreffix, "/DebounceTime")
+				unit: "ms"
+				decimals: 0
+				step: 100
+				min: 0
+				max: 10000
+			}
+			visible: root.isTransferSwitch
+		}
+		MbItemValue
+		{
+			description: qsTr("Suppressed glitches")
+			item.bind: service.path("/SuppressedGlitches")
+			visible: root.isTransferSwitch
+		}
+		MbItemValue
+		{
+			description: qsTr("Changes in the last hour")
+			item.bind: service.path("/ChangesPerHour")
+			visible: root.isTransferSwitch
+		}
 	}
 }
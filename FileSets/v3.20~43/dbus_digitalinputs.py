@@ -5,11 +5,18 @@
 import sys, os
 import signal
 from threading import Thread
-from select import select, epoll, EPOLLPRI
+from select import select, epoll, EPOLLPRI, EPOLLIN
 from functools import partial
-from collections import namedtuple
+from collections import namedtuple, deque
 from argparse import ArgumentParser
 import traceback
+import mmap
+import struct
+import zlib
+import random
+import fcntl
+from glob import glob
+from time import monotonic
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'))
 
 from dbus.mainloop.glib import DBusGMainLoop
@@ -20,7 +27,24 @@ from settingsdevice import SettingsDevice
 
 VERSION = '0.23'
 MAXCOUNT = 2**31-1
-SAVEINTERVAL = 60000
+#### modified for ExtTransferSwitch package
+SAVEINTERVAL = 900000 # counts are journaled in between, localsettings is only written if they changed
+#### added for ExtTransferSwitch package
+JOURNALFILE = '/data/dbus-digitalinputs/counters.journal'
+JOURNALRECORDS = 4096
+JOURNALINTERVAL = 1000 # ms between syncs of the journal pages written since the last one
+RESYNCINTERVAL = 10 # seconds between full rereads of all gpios by the epoll engine
+# polling engine
+POLLINTERVAL = 1.0 # seconds between reads of an idle input
+POLLMININTERVAL = 0.005 # shortest interval an active input is read at
+POLLSAMPLES = 4 # reads per edge spacing while pulses arrive
+POLLALPHA = 0.3 # EWMA smoothing factor applied to each new edge spacing
+# pulse meter rate mode
+RATEINTERVAL = 1000 # ms between /Count, /Aggregate and /Rate updates
+RATEWINDOW = 10 # seconds of edges the rate is computed over
+RATEBUFFER = 4096 # edge timestamps kept per input
+RATEALPHA = 0.3 # EWMA smoothing factor applied to each new rate
+STATSINTERVAL = 60000 # ms between transfer switch statistics and /MissedEdges updates
 
 INPUT_FUNCTION_COUNTER = 1
 INPUT_FUNCTION_INPUT = 2
@@ -66,7 +90,111 @@ class SessionBus(dbus.bus.BusConnection):
     def __new__(cls):
         return dbus.bus.BusConnection.__new__(cls, dbus.bus.BusConnection.TYPE_SESSION)
 
+#### added for ExtTransferSwitch package
+class InputSettings(object):
+    """ The settings of one input, held in the SettingsDevice shared by all
+        inputs under keys of the form '<setting>_<input>'. """
+    __slots__ = ('_settings', '_inp')
+
+    def __init__(self, settings, inp):
+        self._settings = settings
+        self._inp = inp
+
+    def __getitem__(self, setting):
+        return self._settings['{}_{}'.format(setting, self._inp)]
+
+    def __setitem__(self, setting, value):
+        self._settings['{}_{}'.format(setting, self._inp)] = value
+
+#### added for ExtTransferSwitch package
+class CounterJournal(object):
+    """ Pulse counts journaled to a memory mapped ring of fixed size records
+        so little is lost on a crash or power cut without rewriting
+        localsettings. A record (gpio, magic, sequence, count, base, crc32)
+        is appended whenever a count changes; base is the localsettings count
+        at the time. At startup the valid record with the highest sequence
+        number for each gpio wins. Each time the ring wraps all counts are
+        written again so an idle input's last record can't be overwritten.
+        Only the pages written since the last flush are synced. """
+    record = struct.Struct('<HHIIII')
+    magic = 0x4A44
+
+    def __init__(self, path, records=JOURNALRECORDS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = records * self.record.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.records = records
+        self.counts = {}
+        self.seq = 0
+        self.next = 0
+        self.dirty = None # (first, last) byte written since the last flush
+        self._replay()
+
+    @classmethod
+    def open(cls, path):
+        if not path:
+            return None
+        try:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            print ("Counter journal {} not available: {}".format(path, e))
+            return None
+
+    def _replay(self):
+        latest = {}
+        for i in range(self.records):
+            offset = i * self.record.size
+            gpio, magic, seq, count, base, crc = self.record.unpack_from(self.mm, offset)
+            if magic != self.magic or crc != zlib.crc32(self.mm[offset:offset + self.record.size - 4]):
+                continue # never written, older format or torn by a power cut
+            if seq >= self.seq:
+                self.seq = seq + 1
+                self.next = (i + 1) % self.records
+            if gpio not in latest or seq > latest[gpio][0]:
+                latest[gpio] = (seq, (count, base))
+        self.counts = dict((gpio, record) for gpio, (seq, record) in latest.items())
+
+    def get(self, gpio):
+        """ Returns (count, base) of the last record for gpio or None. """
+        return self.counts.get(gpio)
+
+    def _write(self, gpio, count, base):
+        offset = self.next * self.record.size
+        self.record.pack_into(self.mm, offset, gpio, self.magic, self.seq, count, base, 0)
+        crc = zlib.crc32(self.mm[offset:offset + self.record.size - 4])
+        struct.pack_into('<I', self.mm, offset + self.record.size - 4, crc)
+        self.seq += 1
+        self.next = (self.next + 1) % self.records
+        self.counts[gpio] = (count, base)
+        end = offset + self.record.size
+        self.dirty = (offset, end) if self.dirty is None else \
+            (min(self.dirty[0], offset), max(self.dirty[1], end))
+
+    def append(self, gpio, count, base):
+        if self.counts.get(gpio) == (count, base):
+            return
+        if self.next == 0 and self.seq > 0:
+            for g, (c, b) in list(self.counts.items()):
+                if g != gpio:
+                    self._write(g, c, b)
+        self._write(gpio, count, base)
+
+    def flush(self):
+        if self.dirty is not None:
+            first = self.dirty[0] - self.dirty[0] % mmap.PAGESIZE
+            self.mm.flush(first, self.dirty[1] - first)
+            self.dirty = None
+
 class BasePulseCounter(object):
+#### added for ExtTransferSwitch package
+    """ Calling a pulse counter returns an iterator of (gpio, level,
+        timestamp) with the time.monotonic() time the new level was seen. """
     pass
 
 class DebugPulseCounter(BasePulseCounter):
@@ -88,14 +216,33 @@ class DebugPulseCounter(BasePulseCounter):
         from time import sleep
         for level in cycle([0, 1]):
             for gpio in list(self.gpiomap.keys()):
-                yield gpio, level
+                yield gpio, level, monotonic()
                 sleep(0.25/len(self.gpiomap))
 
+#### modified for ExtTransferSwitch package
 class EpollPulseCounter(BasePulseCounter):
-    def __init__(self):
+    """ Waits for edge interrupts and reads only the gpios epoll reports.
+        register/unregister wake the poll through a self-pipe so changes take
+        effect immediately. As a safety net all gpios are reread every
+        resync seconds (0 disables this); edges found only by that reread
+        are counted in missed. """
+    def __init__(self, resync=RESYNCINTERVAL):
         self.gpiomap = {}
+        self.fdmap = {}
         self.states = {}
+        self.missed = {}
+        self.resync = resync
         self.ob = epoll()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.ob.register(self.wakeup_r, EPOLLIN)
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_w, b'\0')
+        except BlockingIOError:
+            pass # already a wakeup pending
 
     def register(self, path, gpio):
         path = os.path.realpath(path)
@@ -107,70 +254,295 @@ class EpollPulseCounter(BasePulseCounter):
         fp = open(os.path.join(path, 'value'), 'rb')
         level = int(fp.read()) # flush it in case it's high at startup
         self.gpiomap[gpio] = fp
+        self.fdmap[fp.fileno()] = gpio
         self.states[gpio] = level
+        self.missed.setdefault(gpio, 0)
         self.ob.register(fp, EPOLLPRI)
+        self.wakeup()
         return level
 
     def unregister(self, gpio):
         fp = self.gpiomap[gpio]
         self.ob.unregister(fp)
+        del self.fdmap[fp.fileno()]
         del self.gpiomap[gpio]
         del self.states[gpio]
         fp.close()
+        self.wakeup()
 
     def registered(self, gpio):
         return gpio in self.gpiomap
 
+    def read(self, gpio):
+        """ Returns the new level if it changed, otherwise None. """
+        fp = self.gpiomap.get(gpio)
+        if fp is None:
+            return None # unregistered by the main thread
+        try:
+            os.lseek(fp.fileno(), 0, os.SEEK_SET)
+            v = int(os.read(fp.fileno(), 1))
+        except (OSError, ValueError):
+            return None # closed by unregister
+        if v == self.states.get(gpio, v):
+            return None
+        self.states[gpio] = v
+        return v
+
     def __call__(self):
+        next_resync = monotonic() + self.resync
         while True:
-            # We have a timeout of 1 second on the poll, because poll() only
-            # looks at files in the epoll object at the time poll() was called.
-            # The timeout means we let other files (added via calls to
-            # register/unregister) into the loop at least that often.
-            self.ob.poll(1)
-
-            # When coming out of the epoll call, we read all the gpios to make
-            # sure we didn't miss any edges.  This is a safety fallback that
-            # ensures everything is up to date once a second, but
-            # edge-triggered results are handled immediately.
-            # NOTE: There has not been a report of a missed interrupt yet.
-            # Belts and suspenders.
-            for gpio, fp in list(self.gpiomap.items()):
-                os.lseek(fp.fileno(), 0, os.SEEK_SET)
-                v = int(os.read(fp.fileno(), 1))
-                if v != self.states[gpio]:
-                    self.states[gpio] = v
-                    yield gpio, v
+            if self.resync > 0:
+                timeout = max(0, next_resync - monotonic())
+            else:
+                timeout = -1
+            events = self.ob.poll(timeout)
+            # the time of the wake-up is the closest to the edge(s)
+            now = monotonic()
+            for fd, event in events:
+                if fd == self.wakeup_r:
+                    # registrations changed, nothing to read
+                    try:
+                        os.read(self.wakeup_r, 512)
+                    except BlockingIOError:
+                        pass
+                    continue
+                gpio = self.fdmap.get(fd)
+                if gpio is None:
+                    continue
+                v = self.read(gpio)
+                if v is not None:
+                    yield gpio, v, now
+
+            # Safety fallback: reread everything in case an interrupt was
+            # missed. These should not happen so count any that do, they
+            # are published on /MissedEdges.
+            if self.resync > 0 and monotonic() >= next_resync:
+                next_resync = monotonic() + self.resync
+                for gpio in list(self.gpiomap.keys()):
+                    v = self.read(gpio)
+                    if v is not None:
+                        self.missed[gpio] = self.missed.get(gpio, 0) + 1
+                        yield gpio, v, monotonic()
+
+#### added for ExtTransferSwitch package
+# GPIO character device uAPI v2 (linux/gpio.h, Linux 5.10 and later)
+GPIO_V2_GET_LINE_IOCTL = 0xC250B407
+GPIO_V2_LINE_GET_VALUES_IOCTL = 0xC010B40E
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_REQUEST_SIZE = 592
+GPIO_V2_LINE_EVENT = struct.Struct('<QIIII24x') # timestamp_ns, id, offset, seqno, line_seqno
+GPIO_EVENT_BUFFER = 1024 # edges the kernel queues per line
+
+class GpiodPulseCounter(EpollPulseCounter):
+    """ Uses line event requests on the GPIO character device. The kernel
+        queues every edge with a CLOCK_MONOTONIC timestamp and all queued
+        events of a line are read in one go, so no edge is lost at high
+        pulse rates and there is no lseek/read per level.
+
+        Inputs are either sysfs gpio paths, which are looked up on their
+        gpiochip and unexported so the line can be requested (and exported
+        again when unregistered), or '/dev/gpiochipN:line', e.g. for lines
+        of the gpio-sim or gpio-mockup test modules. """
+    def __init__(self):
+        super(GpiodPulseCounter, self).__init__(resync=0)
+        self.sysfs = {}
+
+    @staticmethod
+    def find_line(path):
+        """ Returns (chip device, line offset, sysfs gpio number or None). """
+        if path.startswith('/dev/gpiochip'):
+            chip, line = path.rsplit(':', 1)
+            return chip, int(line), None
+        number = int(os.path.basename(os.path.realpath(path))[4:])
+        for chipdir in glob('/sys/class/gpio/gpiochip*'):
+            with open(os.path.join(chipdir, 'base')) as fp:
+                base = int(fp.read())
+            with open(os.path.join(chipdir, 'ngpio')) as fp:
+                ngpio = int(fp.read())
+            if base <= number < base + ngpio:
+                device = glob(os.path.join(chipdir, 'device', 'gpiochip*'))[0]
+                return '/dev/' + os.path.basename(device), number - base, number
+        raise ValueError('no gpiochip found for {}'.format(path))
+
+    def register(self, path, gpio):
+        chip, line, number = self.find_line(path)
+        if number is not None:
+            # the line can't be requested while sysfs holds it
+            with open('/sys/class/gpio/unexport', 'w') as fp:
+                fp.write(str(number))
+            self.sysfs[gpio] = number
+
+        request = bytearray(GPIO_V2_LINE_REQUEST_SIZE)
+        struct.pack_into('<I', request, 0, line)
+        struct.pack_into('32s', request, 256, b'dbus-digitalinputs')
+        struct.pack_into('<Q', request, 288, GPIO_V2_LINE_FLAG_INPUT |
+            GPIO_V2_LINE_FLAG_EDGE_RISING | GPIO_V2_LINE_FLAG_EDGE_FALLING)
+        struct.pack_into('<II', request, 560, 1, GPIO_EVENT_BUFFER)
+        chipfd = os.open(chip, os.O_RDWR)
+        try:
+            fcntl.ioctl(chipfd, GPIO_V2_GET_LINE_IOCTL, request)
+        finally:
+            os.close(chipfd)
+        fd = struct.unpack_from('<i', request, 588)[0]
+        os.set_blocking(fd, False)
+
+        values = bytearray(struct.pack('<QQ', 0, 1))
+        fcntl.ioctl(fd, GPIO_V2_LINE_GET_VALUES_IOCTL, values)
+        level = struct.unpack_from('<Q', values)[0] & 1
+
+        self.gpiomap[gpio] = fd
+        self.fdmap[fd] = gpio
+        self.states[gpio] = level
+        self.missed.setdefault(gpio, 0)
+        self.ob.register(fd, EPOLLIN)
+        self.wakeup()
+        return level
+
+    def unregister(self, gpio):
+        fd = self.gpiomap.pop(gpio)
+        self.ob.unregister(fd)
+        del self.fdmap[fd]
+        del self.states[gpio]
+        os.close(fd)
+        number = self.sysfs.pop(gpio, None)
+        if number is not None:
+            try:
+                with open('/sys/class/gpio/export', 'w') as fp:
+                    fp.write(str(number))
+            except OSError:
+                pass
+        self.wakeup()
+
+    def __call__(self):
+        size = GPIO_V2_LINE_EVENT.size
+        while True:
+            for fd, event in self.ob.poll(-1):
+                if fd == self.wakeup_r:
+                    try:
+                        os.read(self.wakeup_r, 512)
+                    except BlockingIOError:
+                        pass
+                    continue
+                gpio = self.fdmap.get(fd)
+                if gpio is None:
+                    continue
+                try:
+                    data = os.read(fd, size * GPIO_EVENT_BUFFER)
+                except (BlockingIOError, OSError):
+                    continue # nothing queued or closed by unregister
+                for offset in range(0, len(data) - size + 1, size):
+                    timestamp, kind = GPIO_V2_LINE_EVENT.unpack_from(data, offset)[:2]
+                    v = 1 if kind == GPIO_V2_LINE_EVENT_RISING_EDGE else 0
+                    if v != self.states.get(gpio, v):
+                        self.states[gpio] = v
+                        yield gpio, v, timestamp / 1e9
+
+#### modified for ExtTransferSwitch package
+class PolledInput(object):
+    """ Polling state of one input. """
+    __slots__ = ('fp', 'level', 'interval', 'due', 'read', 'edge', 'spacing')
+
+    def __init__(self, fp, level, now):
+        self.fp = fp
+        self.level = level
+        self.interval = POLLINTERVAL
+        self.due = now + POLLINTERVAL
+        self.read = now
+        self.edge = None # time the last edge was seen
+        self.spacing = None # smoothed time between edges
 
 class PollingPulseCounter(BasePulseCounter):
+    """ For boards without edge interrupts. Each input is read with a single
+        pread and has its own interval: while pulses arrive it is read
+        POLLSAMPLES times per edge spacing (no faster than POLLMININTERVAL),
+        once idle it backs off to POLLINTERVAL. Read times are jittered so a
+        periodic signal can't stay in phase with the reads. Edges between
+        two reads can't be seen; while pulses arrive an estimate of those,
+        from the edge spacing and the time between reads, is kept in
+        missed. """
     def __init__(self):
         self.gpiomap = {}
+        self.missed = {}
 
     def register(self, path, gpio):
         path = os.path.realpath(path)
 
-        fp = open(os.path.join(path, 'value'), 'rb')
+        fp = open(os.path.join(path, 'value'), 'rb', buffering=0)
         level = int(fp.read())
-        self.gpiomap[gpio] = [fp, level]
+        self.gpiomap[gpio] = PolledInput(fp, level, monotonic())
+        self.missed.setdefault(gpio, 0)
         return level
 
     def unregister(self, gpio):
-        del self.gpiomap[gpio]
+        self.gpiomap.pop(gpio).fp.close()
 
     def registered(self, gpio):
         return gpio in self.gpiomap
 
+    def estimate_missed(self, gpio, inp, previous, now):
+        """ Edges that probably occurred unseen between the previous read and
+            this one, which saw the level change. Only estimated if pulses
+            were already arriving at the previous read; the level changed so
+            an odd number of edges is assumed. """
+        if inp.spacing is None or previous - inp.edge > inp.spacing:
+            return 0
+        ratio = (now - previous) / inp.spacing
+        edges = int(round(ratio))
+        if edges % 2 == 0:
+            edges += 1 if ratio > edges else -1
+        missed = max(0, edges - 1)
+        if missed:
+            self.missed[gpio] = self.missed.get(gpio, 0) + missed
+        return missed
+
     def __call__(self):
-        from itertools import cycle
         from time import sleep
         while True:
-            for gpio, (fp, level) in list(self.gpiomap.items()):
-                fp.seek(0, os.SEEK_SET)
-                v = int(fp.read())
-                if v != level:
-                    self.gpiomap[gpio][1] = v
-                    yield gpio, v
-            sleep(1)
+            now = monotonic()
+            for gpio, inp in list(self.gpiomap.items()):
+                if inp.due > now:
+                    continue
+                inp.due = now + inp.interval
+                try:
+                    v = int(os.pread(inp.fp.fileno(), 1, 0))
+                except (OSError, ValueError):
+                    continue # closed by unregister
+                previous, inp.read = inp.read, now
+
+                if v == inp.level:
+                    # back off once no edge came for a couple of spacings
+                    if inp.edge is None or inp.spacing is None or now - inp.edge > 2 * inp.spacing:
+                        inp.interval = min(POLLINTERVAL, inp.interval * 2)
+                    inp.due = now + inp.interval * random.uniform(0.75, 1.25)
+                    continue
+
+                missed = self.estimate_missed(gpio, inp, previous, now)
+                if inp.edge is not None:
+                    spacing = (now - inp.edge) / (missed + 1)
+                    if inp.spacing is None:
+                        inp.spacing = spacing
+                    else:
+                        inp.spacing += POLLALPHA * (spacing - inp.spacing)
+                    if inp.edge == previous:
+                        # changed on consecutive reads, the signal may well
+                        # be faster than that
+                        inp.interval = min(inp.spacing / POLLSAMPLES, (now - previous) / 2)
+                    else:
+                        inp.interval = inp.spacing / POLLSAMPLES
+                else:
+                    # first edge after idle, the rate is not known yet
+                    inp.interval /= POLLSAMPLES
+                inp.interval = max(POLLMININTERVAL, min(POLLINTERVAL, inp.interval))
+                inp.edge = now
+                inp.level = v
+                inp.due = now + inp.interval * random.uniform(0.75, 1.25)
+                yield gpio, v, now
+
+            due = [inp.due for inp in list(self.gpiomap.values())]
+            sleep(max(0, min(due) - monotonic()) if due else POLLINTERVAL)
 
 class HandlerMaker(type):
     """ Meta-class for keeping track of all extended classes. """
@@ -180,7 +552,19 @@ class HandlerMaker(type):
         else:
             cls.handlers[cls.type_id] = cls
 
+#### added for ExtTransferSwitch package
+def create_service(name, bus):
+    """ Returns a VeDbusService that is not yet on the bus if velib supports
+        that, so paths can be added and all services registered together.
+        Older velib registers the name straight away. """
+    try:
+        return VeDbusService(name, bus=bus, register=False), False
+    except TypeError:
+        return VeDbusService(name, bus=bus), True
+
 class PinHandler(object, metaclass=HandlerMaker):
+    # no instance dictionary here so that NopPin subclasses can do without one
+    __slots__ = ()
     product_id = 0xFFFF
     _product_name = 'Generic GPIO'
     dbus_name = "digital"
@@ -191,8 +575,13 @@ class PinHandler(object, metaclass=HandlerMaker):
         self.settings = settings
         self._level = 0 # Remember last state
 
-        self.service = VeDbusService(
-            "{}.{}.input{:02d}".format(base, self.dbus_name, gpio), bus=bus)
+#### modified for ExtTransferSwitch package
+        # VeDbusService exports its paths on the connection it is given so
+        # each service needs a connection of its own. Everything else uses
+        # the bus shared by all inputs.
+        self._servicebus = dbusconnection()
+        self.service, self._registered = create_service(
+            "{}.{}.input{:02d}".format(base, self.dbus_name, gpio), self._servicebus)
 
         # Add objects required by ve-api
         self.service.add_path('/Mgmt/ProcessName', __file__)
@@ -215,6 +604,9 @@ class PinHandler(object, metaclass=HandlerMaker):
 
         # We'll count the pulses for all types of services
         self.service.add_path('/Count', value=settings['count'])
+#### added for ExtTransferSwitch package
+        # edges the pulse counter missed (epoll) or estimates it missed (poll)
+        self.service.add_path('/MissedEdges', value=0)
 
     @property
     def product_name(self):
@@ -232,6 +624,9 @@ class PinHandler(object, metaclass=HandlerMaker):
         self.service.__del__()
         del self.service
         self.service = None
+#### added for ExtTransferSwitch package
+        self._servicebus.close()
+        self._servicebus = None
 
     @property
     def level(self):
@@ -241,9 +636,17 @@ class PinHandler(object, metaclass=HandlerMaker):
     def level(self, l):
         self._level = int(bool(l))
 
-    def toggle(self, level):
+#### modified for ExtTransferSwitch package
+    # timestamp is the time.monotonic() time the edge was seen by the poller
+    def toggle(self, level, timestamp=None):
         raise NotImplementedError
 
+    def toggle_batch(self, levels, timestamps=None):
+        """ Apply a burst of edges for this pin in one go. Handlers with a
+            service override this to publish them in one transaction. """
+        for i, level in enumerate(levels):
+            self.toggle(level, timestamps[i] if timestamps else None)
+
     def _toggle(self, level, service):
         # Only increment Count on rising edge.
         if level and level != self._level:
@@ -255,14 +658,22 @@ class PinHandler(object, metaclass=HandlerMaker):
             are changed so the Service can recalculate paths. """
         self.toggle(self._level)
 
+#### modified for ExtTransferSwitch package
     def save_count(self):
-        if self.service is not None:
+        if self.service is not None and self.settings['count'] != self.count:
             self.settings['count'] = self.count
 
     @property
     def active(self):
         return self.service is not None
 
+#### added for ExtTransferSwitch package
+    def register(self):
+        """ Puts the service on the bus once all its paths exist. """
+        if not self._registered:
+            self.service.register()
+            self._registered = True
+
     @property
     def count(self):
         return self.service['/Count']
@@ -271,6 +682,12 @@ class PinHandler(object, metaclass=HandlerMaker):
     def count(self, v):
         self.service['/Count'] = v
 
+#### added for ExtTransferSwitch package
+    @property
+    def journal_count(self):
+        """ The count to journal, including pulses not yet published. """
+        return self.count
+
     @classmethod
     def createHandler(cls, _type, *args, **kwargs):
         if _type in cls.handlers:
@@ -281,6 +698,10 @@ class PinHandler(object, metaclass=HandlerMaker):
 class NopPin(object):
     """ Mixin for a pin with empty behaviour. Mix in BEFORE PinHandler so that
         __init__ overrides the base behaviour. """
+#### added for ExtTransferSwitch package
+    # disabled pins are only placeholders, keep them small
+    __slots__ = ('service', 'bus', 'settings', '_level')
+
     def __init__(self, bus, base, path, gpio, settings):
         self.service = None
         self.bus = bus
@@ -290,7 +711,11 @@ class NopPin(object):
     def deactivate(self):
         pass
 
-    def toggle(self, level):
+#### added for ExtTransferSwitch package
+    def register(self):
+        pass
+
+    def toggle(self, level, timestamp=None):
         self._level = level
 
     def save_count(self):
@@ -311,6 +736,7 @@ class NopPin(object):
 
 class DisabledPin(NopPin, PinHandler):
     """ Place holder for a disabled pin. """
+    __slots__ = ()
     _product_name = 'Disabled'
     type_id = 0
 
@@ -325,15 +751,100 @@ class VolumeCounter(PinHandler):
         super(VolumeCounter, self).__init__(bus, base, path, gpio, settings)
         self.service.add_path('/Aggregate', value=self.count*self.rate,
             gettextcallback=lambda p, v: (str(v) + ' cubic meter'))
+#### added for ExtTransferSwitch package
+        self.service.add_path('/Rate', value=None,
+            gettextcallback=lambda p, v: ('---' if v is None else str(v) + ' cubic meter/hour'))
+        self._edges = deque(maxlen=RATEBUFFER)
+        self._pending = 0
+        self._rateStart = monotonic()
+        self._flow = None
+        self._rateTimer = None
 
     @property
     def rate(self):
         return self.settings['rate']
 
-    def toggle(self, level):
+#### modified for ExtTransferSwitch package
+    # In rate mode (/Settings/DigitalInput/N/RateMode) edges are only
+    # timestamped and counted locally. /Count, /Aggregate and /Rate are
+    # published every RATEINTERVAL so dbus traffic does not depend on the
+    # pulse frequency. /Rate is the EWMA smoothed flow over the last
+    # RATEWINDOW seconds in cubic meter per hour.
+    def toggle(self, level, timestamp=None):
+        self.toggle_batch((level,), (timestamp,))
+
+    def toggle_batch(self, levels, timestamps=None):
+        if self._rateTimer is not None:
+            for i, level in enumerate(levels):
+                if level and level != self._level:
+                    self._pending += 1
+                    self._edges.append((timestamps and timestamps[i]) or monotonic())
+                self._level = level
+            return
+        with self.service as s:
+            for level in levels:
+                super(VolumeCounter, self)._toggle(level, s)
+            s['/Aggregate'] = self.count * self.rate
+
+    def refresh(self):
+        if self.settings['ratemode']:
+            if self._rateTimer is None:
+                self._edges.clear()
+                self._rateStart = monotonic()
+                self._flow = None
+                self._rateTimer = GLib.timeout_add(RATEINTERVAL, self._publish_rate)
+        elif self._rateTimer is not None:
+            self._stop_rate()
+        super(VolumeCounter, self).refresh()
+
+    def _stop_rate(self):
+        GLib.source_remove(self._rateTimer)
+        self._rateTimer = None
+        self._flush_pending()
+        self.service['/Rate'] = None
+
+    @property
+    def journal_count(self):
+        return (self.count + self._pending) % MAXCOUNT
+
+    def _flush_pending(self):
+        if self._pending:
+            self.count = (self.count + self._pending) % MAXCOUNT
+            self._pending = 0
+
+    def _publish_rate(self):
+        now = monotonic()
+        while self._edges and self._edges[0] < now - RATEWINDOW:
+            self._edges.popleft()
+        if len(self._edges) == self._edges.maxlen:
+            # buffer wrapped inside the window: rate over the edges it holds
+            elapsed = now - self._edges[0]
+        else:
+            elapsed = min(RATEWINDOW, now - self._rateStart)
+        flow = len(self._edges) / elapsed * 3600 * self.rate if elapsed > 0 else 0
+        if self._flow is None:
+            self._flow = flow
+        else:
+            self._flow += RATEALPHA * (flow - self._flow)
+
         with self.service as s:
-            super(VolumeCounter, self)._toggle(level, s)
+            if self._pending:
+                s['/Count'] = (s['/Count'] + self._pending) % MAXCOUNT
+                self._pending = 0
             s['/Aggregate'] = self.count * self.rate
+            s['/Rate'] = round(self._flow, 4)
+        return True
+
+    def save_count(self):
+        if self.service is not None:
+            self._flush_pending()
+        super(VolumeCounter, self).save_count()
+
+    def deactivate(self):
+        if self._rateTimer is not None:
+            GLib.source_remove(self._rateTimer)
+            self._rateTimer = None
+        super(VolumeCounter, self).deactivate()
 
 class TouchEnable(NopPin, PinHandler):
     """ The pin is used to enable/disable the Touch screen when toggled.
@@ -346,7 +857,7 @@ class TouchEnable(NopPin, PinHandler):
         self.item = VeDbusItemImport(self.bus,
             "com.victronenergy.settings", "/Settings/Gui/TouchEnabled")
 
-    def toggle(self, level):
+    def toggle(self, level, timestamp=None):
         super(TouchEnable, self).toggle(level)
 
         # Toggle the touch-enable setting on the downward edge.
@@ -381,14 +892,24 @@ class PinAlarm(PinHandler):
         self.service.add_path('/Type', value=self.type_id,
             gettextcallback=lambda p, v: INPUTTYPES[v])
 
-    def toggle(self, level):
+#### modified for ExtTransferSwitch package
+    def toggle(self, level, timestamp=None):
         with self.service as s:
             super(PinAlarm, self)._toggle(level, s)
-            s['/InputState'] = bool(level)*1
-            s['/State'] = self.get_state(level)
-            # Ensure that the alarm flag resets if the /AlarmSetting config option
-            # disappears.
-            s['/Alarm'] = self.get_alarm_state(level)
+            self._publish(level, s, timestamp)
+
+    def toggle_batch(self, levels, timestamps=None):
+        with self.service as s:
+            for level in levels:
+                super(PinAlarm, self)._toggle(level, s)
+            self._publish(levels[-1], s, timestamps[-1] if timestamps else None)
+
+    def _publish(self, level, s, timestamp=None):
+        s['/InputState'] = bool(level)*1
+        s['/State'] = self.get_state(level)
+        # Ensure that the alarm flag resets if the /AlarmSetting config option
+        # disappears.
+        s['/Alarm'] = self.get_alarm_state(level)
 
     def get_state(self, level):
         state = level ^ self.settings['invert']
@@ -399,6 +920,56 @@ class PinAlarm(PinHandler):
             (level ^ self.settings['invertalarm']) and self.settings['alarm'])
 
 
+#### added for ExtTransferSwitch package
+class VeBusServices(object):
+    """ The vebus services on a bus, kept up to date from NameOwnerChanged
+        so the generator selection can be sent without a ListNames call,
+        and the main VE.Bus service (com.victronenergy.system /VebusService)
+        which ExtTransferSwitch looks after. One index is shared by all
+        generator inputs on the same bus. """
+    _indexes = {}
+
+    @classmethod
+    def get(cls, bus):
+        index = cls._indexes.get(id(bus))
+        if index is None:
+            index = cls._indexes[id(bus)] = cls(bus)
+        return index
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.mainItem = None
+        bus.add_signal_receiver(self._name_owner_changed,
+            signal_name='NameOwnerChanged', dbus_interface='org.freedesktop.DBus')
+        names = bus.list_names()
+        self.services = set(str(n) for n in names
+            if n.startswith('com.victronenergy.vebus.'))
+        if 'com.victronenergy.system' in names:
+            self._import_main()
+
+    def _import_main(self):
+        try:
+            self.mainItem = VeDbusItemImport(self.bus,
+                'com.victronenergy.system', '/VebusService')
+        except dbus.exceptions.DBusException:
+            self.mainItem = None
+
+    def _name_owner_changed(self, name, oldowner, newowner):
+        if name.startswith('com.victronenergy.vebus.'):
+            if newowner:
+                self.services.add(str(name))
+            else:
+                self.services.discard(str(name))
+        elif name == 'com.victronenergy.system':
+            if newowner:
+                self._import_main()
+            else:
+                self.mainItem = None
+
+    @property
+    def main(self):
+        return self.mainItem.get_value() if self.mainItem is not None else None
+
 class Generator(PinAlarm):
     _product_name = "Generator"
     type_id = 9
@@ -412,30 +983,20 @@ class Generator(PinAlarm):
         self._timer = GLib.timeout_add(30000,
             lambda: self.select_generator(self.level ^ self.settings['invert'] ^ 1) or True)
 
-#### added for ExtTransferSwitch package
-        self.mainVeBusServiceItem = None
-#### end added for ExtTransferSwitch package
-
+#### modified for ExtTransferSwitch package
+        self.vebus = VeBusServices.get(self.bus)
 
     def select_generator(self, v):
 
-        # Find all vebus services, and let them know
+        # Let all vebus services know
         try:
-            services = [n for n in self.bus.list_names() if n.startswith(
-                'com.victronenergy.vebus.')]
-            for n in services:
-#### added for ExtTransferSwitch package
-                # skip this service if it is the main VE.Bus device
-                # processing for that is handled in ExtTransferSwitch
-                try:
-                    if self.mainVeBusServiceItem == None:
-                        self.mainVeBusServiceItem = VeDbusItemImport(self.bus,
-                            "com.victronenergy.service", "/VebusService")
-                    if n == self.mainVeBusService.get_value ():
-                        continue
-                except:
-                    pass
-#### end added for ExtTransferSwitch package
+#### modified for ExtTransferSwitch package
+            # skip the main VE.Bus device if a transfer switch input is configured
+            # processing for that is handled in ExtTransferSwitch
+            main = self.vebus.main if TransferSwitch.configured else None
+            for n in self.vebus.services:
+                if n == main:
+                    continue
 
                 self.bus.call_async(n, '/Ac/Control/RemoteGeneratorSelected', None,
                     'SetValue', 'v', [v], None, None)
@@ -443,12 +1004,17 @@ class Generator(PinAlarm):
             print ("DBus exception setting RemoteGeneratorSelected")
             traceback.print_exc()
 
-    def toggle(self, level):
-        super(Generator, self).toggle(level)
+    def toggle(self, level, timestamp=None):
+        super(Generator, self).toggle(level, timestamp)
 
         # Follow the same inversion sense as for display
         self.select_generator(level ^ self.settings['invert'] ^ 1)
 
+#### added for ExtTransferSwitch package
+    def toggle_batch(self, levels, timestamps=None):
+        super(Generator, self).toggle_batch(levels, timestamps)
+        self.select_generator(levels[-1] ^ self.settings['invert'] ^ 1)
+
     def deactivate(self):
         super(Generator, self).deactivate()
         # When deactivating, reset the generator selection state
@@ -501,10 +1067,156 @@ class GenericIO(PinAlarm):
     translation = 0 # low, high
 
 #### added for ExtTransferSwitch package
-class TransferSwitch(PinAlarm):
+class DebouncedPinAlarm(PinAlarm):
+    """ A PinAlarm that only publishes a new level once it has been stable
+        for the debounce time (/Settings/DigitalInput/N/DebounceTime, ms,
+        0 by default which publishes every edge as before). The time is
+        measured from the edge timestamps, so a delay in processing the
+        edges doesn't change which ones are accepted. Excursions shorter
+        than that are dropped and counted in /SuppressedGlitches, so a
+        chattering contact produces at most one /State change per debounce
+        period. """
+
+    def __init__(self, bus, base, path, gpio, settings):
+        super(DebouncedPinAlarm, self).__init__(bus, base, path, gpio, settings)
+        self.service.add_path('/SuppressedGlitches', value=0)
+        self._pendingLevel = None
+        self._pendingTimestamp = None
+        self._debounceTimer = None
+
+    def _cancel_debounce(self):
+        if self._debounceTimer is not None:
+            GLib.source_remove(self._debounceTimer)
+            self._debounceTimer = None
+        self._pendingLevel = None
+
+    def _raw_edge(self, level, timestamp):
+        """ Called for every edge before debouncing. """
+        pass
+
+    def toggle(self, level, timestamp=None):
+        self.toggle_batch((level,), (timestamp,))
+
+    def toggle_batch(self, levels, timestamps=None):
+        if not timestamps or timestamps[-1] is None:
+            timestamps = [monotonic()] * len(levels)
+        for level, timestamp in zip(levels, timestamps):
+            self._raw_edge(level, timestamp)
+
+        debounce = int(self.settings['debounce']) / 1000.0
+        if debounce <= 0:
+            self._cancel_debounce()
+            super(DebouncedPinAlarm, self).toggle_batch(levels, timestamps)
+            return
+
+        # the pending level still counts from its own edge
+        if self._pendingLevel is not None:
+            levels = [self._pendingLevel] + list(levels)
+            timestamps = [self._pendingTimestamp] + list(timestamps)
+        self._cancel_debounce()
+
+        # a level held until the next edge for the debounce time was stable,
+        # even if the edges are only processed now
+        for i in range(len(levels) - 1):
+            if timestamps[i + 1] - timestamps[i] >= debounce:
+                self._settle(levels[i], timestamps[i])
+
+        # the last edge is stable once the debounce time after it has passed
+        remaining = timestamps[-1] + debounce - monotonic()
+        if remaining <= 0:
+            self._settle(levels[-1], timestamps[-1])
+        else:
+            self._pendingLevel = levels[-1]
+            self._pendingTimestamp = timestamps[-1]
+            self._debounceTimer = GLib.timeout_add(int(remaining * 1000) + 1, self._debounce_expired)
+
+    def _settle(self, level, timestamp):
+        if level == self.level:
+            # input returned to the published level before it was stable
+            self.service['/SuppressedGlitches'] += 1
+        else:
+            # the change is dated from the edge, not the end of the debounce time
+            super(DebouncedPinAlarm, self).toggle(level, timestamp)
+
+    def _debounce_expired(self):
+        self._debounceTimer = None
+        level = self._pendingLevel
+        self._pendingLevel = None
+        if level is not None:
+            self._settle(level, self._pendingTimestamp)
+        return False
+
+    def refresh(self):
+        # republish the stable level without going through the debounce stage
+        super(DebouncedPinAlarm, self).toggle(self.level)
+
+    def deactivate(self):
+        self._cancel_debounce()
+        super(DebouncedPinAlarm, self).deactivate()
+
+class TransferSwitch(DebouncedPinAlarm):
+    """ Also publishes when /State last changed (/LastChangeTime, in
+        time.monotonic() seconds so other services can compute latency from
+        the edge), the number of changes in the last hour and a histogram of
+        the intervals between raw edges. Many short intervals point to a
+        bouncing or degrading contact. """
     _product_name = "External AC Input transfer switch"
     type_id = 12
     translation = 6 # Grid In / Generator In
+    intervals = ((0.01, 'Below10ms'), (0.1, 'Below100ms'), (1, 'Below1s'), (10, 'Below10s'),
+        (60, 'Below1min'), (3600, 'Below1h'), (None, 'Over1h'))
+    configured = set() # gpios of the active transfer switch inputs, see Generator
+
+    def __init__(self, bus, base, path, gpio, settings):
+        super(TransferSwitch, self).__init__(bus, base, path, gpio, settings)
+        TransferSwitch.configured.add(gpio)
+        self.service.add_path('/LastChangeTime', value=None)
+        self.service.add_path('/ChangesPerHour', value=0)
+        for limit, name in self.intervals:
+            self.service.add_path('/EdgeIntervals/' + name, value=0)
+        self._changes = deque()
+        self._lastEdge = None
+        self._histogram = [0] * len(self.intervals)
+        self._publishedLevel = None
+        self._statsTimer = GLib.timeout_add(STATSINTERVAL, self._update_stats)
+
+    def _raw_edge(self, level, timestamp):
+        if self._lastEdge is not None:
+            interval = timestamp - self._lastEdge
+            for i, (limit, name) in enumerate(self.intervals):
+                if limit is None or interval < limit:
+                    self._histogram[i] += 1
+                    break
+        self._lastEdge = timestamp
+
+    def _publish(self, level, s, timestamp=None):
+        super(TransferSwitch, self)._publish(level, s, timestamp)
+        # the first publish only sets the initial state and a refresh after
+        # the invert setting changed is not a change of the input
+        if self._publishedLevel is not None and level != self._publishedLevel:
+            changeTime = timestamp or monotonic()
+            s['/LastChangeTime'] = changeTime
+            self._changes.append(changeTime)
+            self._publish_changes(s)
+        self._publishedLevel = level
+
+    def _publish_changes(self, s):
+        while self._changes and self._changes[0] < monotonic() - 3600:
+            self._changes.popleft()
+        s['/ChangesPerHour'] = len(self._changes)
+
+    # the histogram is only published here so edges don't each cause an update
+    def _update_stats(self):
+        with self.service as s:
+            self._publish_changes(s)
+            for (limit, name), count in zip(self.intervals, self._histogram):
+                s['/EdgeIntervals/' + name] = count
+        return True
+
+    def deactivate(self):
+        GLib.source_remove(self._statsTimer)
+        TransferSwitch.configured.discard(self.gpio)
+        super(TransferSwitch, self).deactivate()
 
 
 def dbusconnection():
@@ -517,14 +1229,21 @@ def main():
         help='Base service name on dbus, default is com.victronenergy',
         default='com.victronenergy')
     parser.add_argument('--poll',
-        help='Use a different kind of polling. Options are epoll, dumb and debug',
+        help='Use a different kind of polling. Options are epoll, gpiod, poll and debug',
         default='epoll')
+#### added for ExtTransferSwitch package
+    parser.add_argument('--resync', type=float, default=RESYNCINTERVAL,
+        help='Seconds between full rereads of all inputs by the epoll engine, 0 disables. Default is {}'.format(RESYNCINTERVAL))
+    parser.add_argument('--journal', default=JOURNALFILE,
+        help='Pulse count journal file, empty to disable. Default is {}'.format(JOURNALFILE))
     parser.add_argument('inputs', nargs='+', help='Path to digital input')
     args = parser.parse_args()
 
     PulseCounter = {
         'debug': DebugPulseCounter,
         'poll': PollingPulseCounter,
+#### added for ExtTransferSwitch package
+        'gpiod': GpiodPulseCounter,
     }.get(args.poll, EpollPulseCounter)
 
     DBusGMainLoop(set_as_default=True)
@@ -532,9 +1251,16 @@ def main():
     # Keep track of enabled services
     services = {}
     inputs = dict(enumerate(args.inputs, 1))
-    pulses = PulseCounter() # callable that iterates over pulses
+#### modified for ExtTransferSwitch package
+    if PulseCounter is EpollPulseCounter:
+        pulses = PulseCounter(resync=args.resync) # callable that iterates over pulses
+    else:
+        pulses = PulseCounter()
 
-    def register_gpio(path, gpio, bus, settings):
+#### modified for ExtTransferSwitch package
+    # At startup services are put on the bus together once every handler is
+    # built and the journal replayed (register=False)
+    def register_gpio(path, gpio, bus, settings, register=True):
         _type = settings['inputtype']
         print ("Registering GPIO {} for type {}".format(gpio, _type))
 
@@ -546,6 +1272,8 @@ def main():
         if _type > 0:
             handler.level = pulses.register(path, gpio)
             handler.refresh()
+        if register:
+            handler.register()
 
     def unregister_gpio(gpio):
         print ("unRegistering GPIO {}".format(gpio))
@@ -579,7 +1307,7 @@ def main():
             elif old:
                 # Input disabled
                 unregister_gpio(inp)
-        elif setting in ('rate', 'invert', 'alarm', 'invertalarm'):
+        elif setting in ('rate', 'invert', 'alarm', 'invertalarm', 'ratemode'):
             services[inp].refresh()
         elif setting == 'name':
             services[inp].product_name = new
@@ -592,8 +1320,16 @@ def main():
                 s.count = v
                 s.refresh()
 
-    for inp, pth in inputs.items():
-        supported_settings = {
+#### modified for ExtTransferSwitch package
+    # One connection and one SettingsDevice for all inputs. Changes are
+    # dispatched to the input named in the setting key.
+    def dispatch_setting_change(key, old, new):
+        setting, inp = key.rsplit('_', 1)
+        handle_setting_change(int(inp), setting, old, new)
+
+    supported_settings = {}
+    for inp in inputs:
+        for setting, value in {
             'inputtype': ['/Settings/DigitalInput/{}/Type'.format(inp), 0, 0, len(INPUTTYPES)-1],
             'rate': ['/Settings/DigitalInput/{}/Multiplier'.format(inp), 0.001, 0, 1.0],
             'count': ['/Settings/DigitalInput/{}/Count'.format(inp), 0, 0, MAXCOUNT, 1],
@@ -601,23 +1337,75 @@ def main():
             'invertalarm': ['/Settings/DigitalInput/{}/InvertAlarm'.format(inp), 0, 0, 1],
             'alarm': ['/Settings/DigitalInput/{}/AlarmSetting'.format(inp), 0, 0, 1],
             'name': ['/Settings/DigitalInput/{}/CustomName'.format(inp), '', '', ''],
-        }
-        bus = dbusconnection()
-        sd = SettingsDevice(bus, supported_settings, partial(handle_setting_change, inp), timeout=10)
-        register_gpio(pth, inp, bus, sd)
+            'debounce': ['/Settings/DigitalInput/{}/DebounceTime'.format(inp), 0, 0, 10000],
+            'ratemode': ['/Settings/DigitalInput/{}/RateMode'.format(inp), 0, 0, 1],
+        }.items():
+            supported_settings['{}_{}'.format(setting, inp)] = value
 
-    def poll(mainloop):
-        from time import time
-        idx = 0
+    bus = dbusconnection()
+    sd = SettingsDevice(bus, supported_settings, dispatch_setting_change, timeout=10)
+    for inp, pth in inputs.items():
+        register_gpio(pth, inp, bus, InputSettings(sd, inp), register=False)
+
+    # Counts journaled since localsettings was last written win, unless the
+    # setting was changed (e.g. reset) while the service was not running
+    journal = CounterJournal.open(args.journal)
+    if journal is not None:
+        for inp, handler in services.items():
+            record = journal.get(inp)
+            if handler.service is None or record is None:
+                continue
+            count, base = record
+            if base != int(handler.settings['count']):
+                print ("Not restoring GPIO {} count {} from journal, the setting was changed to {}".format(
+                    inp, count, handler.settings['count']))
+            elif count != handler.count:
+                print ("Restoring GPIO {} count {} from journal".format(inp, count))
+                handler.count = count
+                handler.refresh()
+
+    for handler in services.values():
+        handler.register()
 
+#### modified for ExtTransferSwitch package
+    # The poller thread only queues edges; they are applied on the main loop
+    # which owns the dbus services. deque append and popleft are atomic so no
+    # lock is needed. A drain is scheduled when the queue was idle, and every
+    # edge that arrived before it runs is applied in one transaction per gpio.
+    edges = deque()
+    drain_scheduled = [False]
+
+    def drain_edges():
+        drain_scheduled[0] = False
+        batches = {}
+        while True:
+            try:
+                inp, level, timestamp = edges.popleft()
+            except IndexError:
+                break
+            levels, timestamps = batches.setdefault(inp, ([], []))
+            levels.append(level)
+            timestamps.append(timestamp)
+
+        for inp, (levels, timestamps) in batches.items():
+            # We may receive a pulse for something that's been deregistered.
+            try:
+                handler = services[inp]
+            except KeyError:
+                continue
+            handler.toggle_batch(levels, timestamps)
+#### added for ExtTransferSwitch package
+            if journal is not None and handler.service is not None:
+                journal.append(inp, handler.journal_count, int(handler.settings['count']))
+        return False
+
+    def poll(mainloop):
         try:
-            for inp, level in pulses():
-                # epoll object only resyncs once a second. We may receive
-                # a pulse for something that's been deregistered.
-                try:
-                    services[inp].toggle(level)
-                except KeyError:
-                    continue
+            for inp, level, timestamp in pulses():
+                edges.append((inp, level, timestamp))
+                if not drain_scheduled[0]:
+                    drain_scheduled[0] = True
+                    GLib.idle_add(drain_edges)
         except:
             traceback.print_exc()
             mainloop.quit()
@@ -630,10 +1418,36 @@ def main():
     poller.daemon = True
     poller.start()
 
+#### added for ExtTransferSwitch package
+    # Missed edges are published rather than printed as they are found
+    def publish_missed():
+        for inp, handler in services.items():
+            if handler.service is not None:
+                handler.service['/MissedEdges'] = pulses.missed.get(inp, 0)
+        return True
+    if hasattr(pulses, 'missed'):
+        GLib.timeout_add(STATSINTERVAL, publish_missed)
+
+#### added for ExtTransferSwitch package
+    # Edges are journaled as they are applied. This also records counts and
+    # bases changed through the settings, then syncs what was written.
+    def journal_counters():
+        for inp, handler in services.items():
+            if handler.service is not None:
+                journal.append(inp, handler.journal_count, int(handler.settings['count']))
+        journal.flush()
+        return True
+    if journal is not None:
+        GLib.timeout_add(JOURNALINTERVAL, journal_counters)
+
     # Periodically save the counter
     def save_counters():
         for inp in inputs:
             services[inp].save_count()
+#### added for ExtTransferSwitch package
+        # the records now have a new base
+        if journal is not None:
+            journal_counters()
         return True
     GLib.timeout_add(SAVEINTERVAL, save_counters)
 
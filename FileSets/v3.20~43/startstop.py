@@ -23,6 +23,8 @@ import sys
 import json
 import os
 import logging
+import heapq
+import math
 from collections import OrderedDict
 import monotonic_time
 from gen_utils import SettingsPrefix, Errors, States, enum
@@ -31,6 +33,8 @@ from gen_utils import create_dbus_service
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), 'ext', 'velib_python'))
 from ve_utils import exit_on_error
 from settingsdevice import SettingsDevice
+#### ExtTransferSwitch warm-up / cool-down
+from gi.repository import GLib
 
 RunningConditions = enum(
 		Stopped = 0,
@@ -53,8 +57,28 @@ Capabilities = enum(
 SYSTEM_SERVICE = 'com.victronenergy.system'
 BATTERY_PREFIX = '/Dc/Battery'
 HISTORY_DAYS = 30
+#### ExtTransferSwitch
+# paths that determine which AC input the generator is on
+GENERATOR_AC_INPUT_PATHS = (
+	('com.victronenergy.settings', '/Settings/SystemSetup/AcInput1'),
+	('com.victronenergy.settings', '/Settings/SystemSetup/AcInput2'),
+	(SYSTEM_SERVICE, '/Ac/In/NumberOfAcInputs'))
 WAIT_FOR_ENGINE_STOP = 15
 
+#### ExtTransferSwitch per-phase paths, built once rather than on every evaluation
+PHASES = ('L1', 'L2', 'L3')
+AC_OUT_POWER_PATHS = tuple('/Ac/Out/%s/P' % phase for phase in PHASES)
+# '/Ac/Consumption/%s/Power' is deprecated
+CONSUMPTION_PATHS = tuple(path % phase for phase in PHASES
+	for path in ('/Ac/ConsumptionOnInput/%s/Power', '/Ac/ConsumptionOnOutput/%s/Power'))
+HIGH_TEMPERATURE_PHASE_PATHS = tuple('/Alarms/%s/HighTemperature' % phase for phase in PHASES)
+OVERLOAD_PHASE_PATHS = tuple('/Alarms/%s/Overload' % phase for phase in PHASES)
+
+def get_values(monitor, service, paths):
+	# DbusMonitor comes with velib_python, so the bulk read is done here
+	get_value = monitor.get_value
+	return [get_value(service, path) for path in paths]
+
 def safe_max(args):
 	try:
 		return max(x for x in args if x is not None)
@@ -70,6 +94,12 @@ class Condition(object):
 		self.valid = True
 		self.enabled = False
 		self.retries = 0
+#### ExtTransferSwitch event-driven conditions
+		# only evaluated again when an input changed or a deadline passed
+		self.dirty = True
+		self.result = False
+		# time of the live entry in the deadline heap, others are stale
+		self.deadline = None
 
 	def __getitem__(self, key):
 		try:
@@ -83,6 +113,11 @@ class Condition(object):
 	def get_value(self):
 		raise NotImplementedError("get_value")
 
+#### ExtTransferSwitch event-driven conditions
+	def inputs(self):
+		""" The (service, path) pairs get_value reads """
+		return ()
+
 	@property
 	def vebus_service(self):
 		return self.parent._vebusservice if self.parent._vebusservice else ''
@@ -100,6 +135,9 @@ class SocCondition(Condition):
 	def get_value(self):
 		return self.parent._get_battery().soc
 
+	def inputs(self):
+		return (self.parent._get_battery().input('Soc'),)
+
 class AcLoadCondition(Condition):
 	name = 'acload'
 	monitoring = 'vebus'
@@ -107,34 +145,32 @@ class AcLoadCondition(Condition):
 	timed = True
 
 	def get_value(self):
-		loadOnAcOut = []
-		totalConsumption = []
-
-		for phase in ['L1', 'L2', 'L3']:
-			# Get the values directly from the inverter, systemcalc doesn't provide raw inverted power
-			loadOnAcOut.append(self.monitor.get_value(self.vebus_service, ('/Ac/Out/%s/P' % phase)))
-
-			# Calculate total consumption, '/Ac/Consumption/%s/Power' is deprecated
-			c_i = self.monitor.get_value(SYSTEM_SERVICE, ('/Ac/ConsumptionOnInput/%s/Power' % phase))
-			c_o = self.monitor.get_value(SYSTEM_SERVICE, ('/Ac/ConsumptionOnOutput/%s/Power' % phase))
-			totalConsumption.append(sum(filter(None, (c_i, c_o))))
+#### ExtTransferSwitch per-phase paths
+		# Get the values directly from the inverter, systemcalc doesn't provide raw inverted power
+		loadOnAcOut = get_values(self.monitor, self.vebus_service, AC_OUT_POWER_PATHS)
 
 		# Invalidate if vebus is not available
 		if loadOnAcOut[0] == None:
 			return None
 
+		acloadmeasurement = self.parent._settings['acloadmeasurement']
+
 		# Total consumption
-		if self.parent._settings['acloadmeasurement'] == 0:
-			return sum(filter(None, totalConsumption))
+		if acloadmeasurement == 0:
+			return sum(filter(None, get_values(self.monitor, SYSTEM_SERVICE, CONSUMPTION_PATHS)))
 
 		# Load on inverter AC out
-		if self.parent._settings['acloadmeasurement'] == 1:
+		if acloadmeasurement == 1:
 			return sum(filter(None, loadOnAcOut))
 
 		# Highest phase load
-		if self.parent._settings['acloadmeasurement'] == 2:
+		if acloadmeasurement == 2:
 			return safe_max(loadOnAcOut)
 
+	def inputs(self):
+		return [(self.vebus_service, path) for path in AC_OUT_POWER_PATHS] + \
+			[(SYSTEM_SERVICE, path) for path in CONSUMPTION_PATHS]
+
 class BatteryCurrentCondition(Condition):
 	name = 'batterycurrent'
 	monitoring = 'battery'
@@ -147,6 +183,9 @@ class BatteryCurrentCondition(Condition):
 			c *= -1
 		return c
 
+	def inputs(self):
+		return (self.parent._get_battery().input('Current'),)
+
 class BatteryVoltageCondition(Condition):
 	name = 'batteryvoltage'
 	monitoring = 'battery'
@@ -156,6 +195,9 @@ class BatteryVoltageCondition(Condition):
 	def get_value(self):
 		return self.parent._get_battery().voltage
 
+	def inputs(self):
+		return (self.parent._get_battery().input('Voltage'),)
+
 class InverterTempCondition(Condition):
 	name = 'inverterhightemp'
 	monitoring = 'vebus'
@@ -170,13 +212,13 @@ class InverterTempCondition(Condition):
 		# /Alarms/HighTemperature... but when connected to vebus alarms are
 		# splitted in three phases and published to /Alarms/LX/HighTemperature...
 		if v is None:
-			inverterHighTemp = []
-			for phase in ['L1', 'L2', 'L3']:
-				# Inverter alarms must be fetched directly from the inverter service
-				inverterHighTemp.append(self.monitor.get_value(self.vebus_service, ('/Alarms/%s/HighTemperature' % phase)))
-			return safe_max(inverterHighTemp)
+			# Inverter alarms must be fetched directly from the inverter service
+			return safe_max(get_values(self.monitor, self.vebus_service, HIGH_TEMPERATURE_PHASE_PATHS))
 		return v
 
+	def inputs(self):
+		return [(self.vebus_service, path) for path in ('/Alarms/HighTemperature',) + HIGH_TEMPERATURE_PHASE_PATHS]
+
 class InverterOverloadCondition(Condition):
 	name = 'inverteroverload'
 	monitoring = 'vebus'
@@ -191,13 +233,13 @@ class InverterOverloadCondition(Condition):
 		# /Alarms/Overload... but when connected to vebus alarms are
 		# splitted in three phases and published to /Alarms/LX/Overload...
 		if v is None:
-			inverterOverload = []
-			for phase in ['L1', 'L2', 'L3']:
-				# Inverter alarms must be fetched directly from the inverter service
-				inverterOverload.append(self.monitor.get_value(self.vebus_service, ('/Alarms/%s/Overload' % phase)))
-			return safe_max(inverterOverload)
+			# Inverter alarms must be fetched directly from the inverter service
+			return safe_max(get_values(self.monitor, self.vebus_service, OVERLOAD_PHASE_PATHS))
 		return v
 
+	def inputs(self):
+		return [(self.vebus_service, path) for path in ('/Alarms/Overload',) + OVERLOAD_PHASE_PATHS]
+
 class StopOnAc1Condition(Condition):
 	name = 'stoponac1'
 	monitoring = 'vebus'
@@ -222,6 +264,10 @@ class StopOnAc1Condition(Condition):
 
 		return bool(available)
 
+	def inputs(self):
+		return [(self.vebus_service, path) for path in
+			('/Ac/State/AcIn1Available', '/Ac/ActiveIn/ActiveInput', '/Ac/ActiveIn/Connected')]
+
 class StopOnAc2Condition(Condition):
 	name = 'stoponac2'
 	monitoring = 'vebus'
@@ -235,6 +281,9 @@ class StopOnAc2Condition(Condition):
 
 		return None if available is None else bool(available)
 
+	def inputs(self):
+		return ((self.vebus_service, '/Ac/State/AcIn2Available'),)
+
 class Battery(object):
 	def __init__(self, monitor, service, prefix):
 		self.monitor = monitor
@@ -243,17 +292,102 @@ class Battery(object):
 
 	@property
 	def voltage(self):
-		return self.monitor.get_value(self.service, self.prefix + '/Voltage')
+		return self.monitor.get_value(*self.input('Voltage'))
 
 	@property
 	def current(self):
-		return self.monitor.get_value(self.service, self.prefix + '/Current')
+		return self.monitor.get_value(*self.input('Current'))
 
 	@property
 	def soc(self):
-		# Soc from the device doesn't have the '/Dc/0' prefix like the current and voltage do, but it does
-		# have the same prefix on systemcalc
-		return self.monitor.get_value(self.service, (BATTERY_PREFIX if self.prefix == BATTERY_PREFIX else '') + '/Soc')
+		return self.monitor.get_value(*self.input('Soc'))
+
+#### ExtTransferSwitch event-driven conditions
+	def input(self, name):
+		""" The (service, path) a value is read from """
+		if name == 'Soc':
+			# Soc from the device doesn't have the '/Dc/0' prefix like the current and voltage do, but it does
+			# have the same prefix on systemcalc
+			return self.service, (BATTERY_PREFIX if self.prefix == BATTERY_PREFIX else '') + '/Soc'
+		return self.service, self.prefix + '/' + name
+
+#### ExtTransferSwitch runtime history
+class RuntimeHistory(object):
+	""" Generator runtime per day for the last HISTORY_DAYS days, indexed by
+		day number (the UTC timestamp of the local date / 86400). The ring
+		holds running totals, so the runtime over any number of days is
+		one subtraction and adding to today touches a single slot. """
+	def __init__(self, size=HISTORY_DAYS):
+		self.size = size
+		self.totals = [0] * size
+		self.day = None # newest day in the ring
+		self.base = 0 # running total before the oldest day in the ring
+		self.dirty = False
+
+	@classmethod
+	def from_json(cls, text, size=HISTORY_DAYS):
+		""" Loads the AccumulatedDaily setting: {"<timestamp>": seconds} """
+		history = cls(size)
+		try:
+			days = sorted((int(k) // 86400, v) for k, v in json.loads(text).items())
+		except (ValueError, TypeError, AttributeError):
+			days = []
+		for day, seconds in days:
+			history.add(day, seconds)
+		history.dirty = False
+		return history
+
+	def to_json(self):
+		days = {}
+		if self.day is not None:
+			for day in range(max(self.day - self.size + 1, 0), self.day + 1):
+				seconds = self.runtime(day)
+				if seconds or day == self.day:
+					days[str(day * 86400)] = seconds
+		return json.dumps(days, sort_keys=True, separators=(',', ':'))
+
+	def _advance(self, day):
+		if self.day is None:
+			self.day = day
+			return
+		total = self.totals[self.day % self.size]
+		if day - self.day >= self.size:
+			# the whole ring drops out
+			self.base = total
+			self.totals = [total] * self.size
+		else:
+			for d in range(self.day + 1, day + 1):
+				# this slot held the day dropping out of the ring
+				self.base = self.totals[d % self.size]
+				self.totals[d % self.size] = total
+		self.day = day
+
+	def add(self, day, seconds):
+		if self.day is None or day > self.day:
+			self._advance(day)
+			self.dirty = True
+		if day <= self.day - self.size or not seconds:
+			return
+		# only more than one slot if the clock went back a day
+		for d in range(day, self.day + 1):
+			self.totals[d % self.size] += seconds
+		self.dirty = True
+
+	def _total(self, day):
+		if day <= self.day - self.size:
+			return self.base
+		return self.totals[min(day, self.day) % self.size]
+
+	def runtime(self, day):
+		if self.day is None or day > self.day:
+			return 0
+		return self._total(day) - self._total(day - 1)
+
+	def total(self, today, days):
+		""" Runtime over the days days up to and including today. """
+		if self.day is None or days <= 0:
+			return 0
+		return self._total(today) - self._total(today - days)
 
 class StartStop(object):
 	_driver = None
@@ -277,6 +411,7 @@ class StartStop(object):
 		self._warmUpEndTime = 0
 		self._coolDownEndTime = 0
 		self._postCoolDownEndTime = 0
+		self._deadlineTimer = None
 		self._ac1isIgnored = False
 		self._ac2isIgnored = False
 		self._activeAcInIsIgnored = False 
@@ -287,6 +422,13 @@ class StartStop(object):
 		self._manualstarttimer = 0
 		self._last_runtime_update = 0
 		self._timer_runnning = 0
+#### ExtTransferSwitch runtime history
+		self._runtime_history = None
+		self._accumulateddaily = None # AccumulatedDaily as last loaded or written
+#### ExtTransferSwitch event-driven conditions
+		self._condition_inputs = {} # (service, path): conditions reading it
+		self._deadlines = [] # heap of (time, sequence, condition) for condition timers
+		self._deadline_sequence = 0
 
 		# The installer left autostart disabled
 		self.AUTOSTART_DISABLED_ALARM_TIME = 600
@@ -372,6 +514,12 @@ class StartStop(object):
 		# Service countdown, calculated by running time and service interval
 		self._dbusservice.add_path('/ServiceCounter', value=None)
 		self._dbusservice.add_path('/ServiceCounterReset', value=None, writeable=True, onchangecallback=self._reset_service_counter)
+#### ExtTransferSwitch warm-up / cool-down
+		# Time left in warm-up and cool-down
+		self._dbusservice.add_path('/WarmUpRemaining', value=None, gettextcallback=self._seconds_to_text)
+		self._dbusservice.add_path('/CoolDownRemaining', value=None, gettextcallback=self._seconds_to_text)
+		# AC input the generator is connected to: 0 = none, 1 = AC in 1, 2 = AC in 2
+		self._dbusservice.add_path('/GeneratorAcInput', value=None)
 		# Publish what service we're controlling, and the productid
 		self._dbusservice.add_path('/GensetService', value=self._remoteservice)
 		self._dbusservice.add_path('/GensetInstance',
@@ -403,6 +551,10 @@ class StartStop(object):
 		self._dbusservice['/ServiceInterval'] = int(self._settings['serviceinterval'])
 		self._dbusservice['/ServiceCounter'] = None
 		self._dbusservice['/ServiceCounterReset'] = 0
+#### ExtTransferSwitch warm-up / cool-down
+		self._dbusservice['/WarmUpRemaining'] = 0
+		self._dbusservice['/CoolDownRemaining'] = 0
+		self._update_generator_ac_input (force=True)
 
 	@property
 	def capabilities(self):
@@ -442,11 +594,17 @@ class StartStop(object):
 		self.log_info('Removed from start/stop instances')
 
 	def _remove_service(self):
+#### ExtTransferSwitch warm-up / cool-down
+		self._cancel_deadline ()
 		self._dbusservice.__del__()
 		self._dbusservice = None
 
 	def device_added(self, dbusservicename, instance):
 		self._determineservices()
+#### ExtTransferSwitch warm-up / cool-down
+		# values of a new service don't come through dbus_value_changed
+		if dbusservicename in ('com.victronenergy.settings', SYSTEM_SERVICE):
+			self._update_generator_ac_input ()
 
 	def device_removed(self, dbusservicename, instance):
 		self._determineservices()
@@ -464,6 +622,14 @@ class StartStop(object):
 		if self._dbusservice is None:
 			return
 
+#### ExtTransferSwitch event-driven conditions
+		for condition in self._condition_inputs.get((dbusServiceName, dbusPath), ()):
+			condition.dirty = True
+
+#### ExtTransferSwitch warm-up / cool-down
+		if (dbusServiceName, dbusPath) in GENERATOR_AC_INPUT_PATHS:
+			self._update_generator_ac_input ()
+
 		# AcIn1Available is needed to determine capabilities, but may
 		# only show up later. So we have to wait for it here.
 		if self._vebusservice is not None and \
@@ -488,6 +654,11 @@ class StartStop(object):
 
 		s = self._settings.removeprefix(setting)
 
+#### ExtTransferSwitch event-driven conditions
+		# thresholds, timers and enables are all settings
+		if self._is_condition_setting(s):
+			self._mark_conditions_dirty()
+
 		if s == 'batterymeasurement':
 			self._determineservices()
 			# Reset retries and valid if service changes
@@ -500,6 +671,11 @@ class StartStop(object):
 			self.log_info('Autostart function %s.' % ('enabled' if newvalue == 1 else 'disabled'))
 			self._dbusservice['/AutoStartEnabled'] = self._settings['autostart']
 
+#### ExtTransferSwitch runtime history
+		# reload the history if something else changed it
+		if s == 'accumulateddaily' and newvalue != self._accumulateddaily:
+			self._runtime_history = None
+
 		if self._dbusservice is not None and s == 'testruninterval':
 			self._dbusservice['/TestRunIntervalRuntime'] = self._interval_runtime(
 															self._settings['testruninterval'])
@@ -536,20 +712,6 @@ class StartStop(object):
 		if not self._enabled:
 			return
 
-#### ExtTransferSwitch warm-up / cool-down
-		# determine which AC input is connected to the generator
-		try:
-			if self._dbusmonitor.get_value ('com.victronenergy.settings', '/Settings/SystemSetup/AcInput1') == 2:
-				self._generatorAcInput = 1
-			elif self._dbusmonitor.get_value (SYSTEM_SERVICE, '/Ac/In/NumberOfAcInputs') >= 2 \
-					and self._dbusmonitor.get_value ('com.victronenergy.settings', '/Settings/SystemSetup/AcInput2') == 2:
-				self._generatorAcInput = 2
-			# no generator input found
-			else:
-				self._generatorAcInput = 0
-		except:
-			self._generatorAcInput = 0
-
 #### ExtTransferSwitch warm-up / cool-down
 		self._currentTime = self._get_monotonic_seconds ()
 
@@ -579,6 +741,66 @@ class StartStop(object):
 		#	and the input type changed by the ExtTransferSwitch service
 		if state == States.RUNNING and self._acInIsGenerator:
 			self._coolDownEndTime = self._currentTime + self._settings['cooldowntime']
+
+		self._update_remaining ()
+
+	# determine which AC input is connected to the generator
+	#	only needed when one of GENERATOR_AC_INPUT_PATHS changes
+	def _update_generator_ac_input (self, force=False):
+		# a disabled instance has no service - enable () publishes it
+		if self._dbusservice is None:
+			return
+		monitor = self._dbusmonitor
+		if monitor.get_value ('com.victronenergy.settings', '/Settings/SystemSetup/AcInput1') == 2:
+			generatorAcInput = 1
+		elif (monitor.get_value (SYSTEM_SERVICE, '/Ac/In/NumberOfAcInputs') or 0) >= 2 \
+				and monitor.get_value ('com.victronenergy.settings', '/Settings/SystemSetup/AcInput2') == 2:
+			generatorAcInput = 2
+		# no generator input found
+		else:
+			generatorAcInput = 0
+
+		if generatorAcInput != self._generatorAcInput or force:
+			if generatorAcInput == 0:
+				self.log_info ("no generator AC input")
+			else:
+				self.log_info ("generator is on AC input %d" % generatorAcInput)
+			self._generatorAcInput = generatorAcInput
+			self._dbusservice['/GeneratorAcInput'] = generatorAcInput
+
+	# publish the time left in warm-up and cool-down
+	def _update_remaining (self):
+		state = self._dbusservice['/State']
+		if state == States.WARMUP:
+			warmUpRemaining = max (0, int (math.ceil (self._warmUpEndTime - self._currentTime)))
+		else:
+			warmUpRemaining = 0
+		if state == States.COOLDOWN:
+			coolDownRemaining = max (0, int (math.ceil (self._coolDownEndTime - self._currentTime)))
+		else:
+			coolDownRemaining = 0
+		if self._dbusservice['/WarmUpRemaining'] != warmUpRemaining:
+			self._dbusservice['/WarmUpRemaining'] = warmUpRemaining
+		if self._dbusservice['/CoolDownRemaining'] != coolDownRemaining:
+			self._dbusservice['/CoolDownRemaining'] = coolDownRemaining
+
+	# warm-up, cool-down and post cool-down end at an exact time
+	#	rather than on the next 1 second tick: run tick () again when the end time is reached
+	#	only one of these periods can be active so one timer is enough
+	def _schedule_deadline (self, endTime):
+		self._cancel_deadline ()
+		delay = max (0, int (math.ceil ((endTime - self._get_monotonic_seconds ()) * 1000)))
+		self._deadlineTimer = GLib.timeout_add (delay, exit_on_error, self._deadline_reached)
+
+	def _cancel_deadline (self):
+		if self._deadlineTimer is not None:
+			GLib.source_remove (self._deadlineTimer)
+			self._deadlineTimer = None
+
+	def _deadline_reached (self):
+		self._deadlineTimer = None
+		self.tick ()
+		return False
 #### end ExtTransferSwitch warm-up / cool-down
 
 
@@ -605,6 +827,15 @@ class StartStop(object):
 		connection_lost = False
 		running = self._dbusservice['/State'] in (States.RUNNING, States.WARMUP)
 
+#### ExtTransferSwitch event-driven conditions
+		# conditions whose start or stop timer ran out need evaluating again
+		now = time.time()
+		while self._deadlines and self._deadlines[0][0] <= now:
+			when, sequence, condition = heapq.heappop(self._deadlines)
+			if condition.deadline == when:
+				condition.deadline = None
+				condition.dirty = True
+
 		self._check_quiet_hours()
 
 		# New day, register it
@@ -638,8 +869,8 @@ class StartStop(object):
 			# Evaluate stop on AC IN conditions first, when this conditions are enabled and reached the generator
 			# will stop as soon as AC IN in active. Manual and testrun conditions will make the generator start
 			# or keep it running.
-			stop_on_ac_reached = (self._evaluate_condition(self._condition_stack[StopOnAc1Condition.name]) or
-						       self._evaluate_condition(self._condition_stack[StopOnAc2Condition.name]))
+			stop_on_ac_reached = (self._condition_reached(self._condition_stack[StopOnAc1Condition.name]) or
+						       self._condition_reached(self._condition_stack[StopOnAc2Condition.name]))
 			stop_by_ac1_ac2 = startbycondition not in ['manual', 'testrun'] and stop_on_ac_reached
 
 			if stop_by_ac1_ac2 and running and activecondition not in ['manual', 'testrun']:
@@ -658,7 +889,7 @@ class StartStop(object):
 						break
 
 				# Don't short-circuit this, _evaluate_condition sets .reached
-				start = self._evaluate_condition(data) or start
+				start = self._condition_reached(data) or start
 				startbycondition = condition if start and startbycondition is None else startbycondition
 				# Connection lost is set to true if the number of retries of one or more enabled conditions
 				# >= RETRIES_ON_ERROR
@@ -765,6 +996,9 @@ class StartStop(object):
 
 	def _reset_condition(self, condition):
 		condition['reached'] = False
+#### ExtTransferSwitch event-driven conditions
+		condition['dirty'] = True
+		condition['deadline'] = None
 		if condition['timed']:
 			condition['start_timer'] = 0
 			condition['stop_timer'] = 0
@@ -800,6 +1034,9 @@ class StartStop(object):
 				condition['retries'] += 1
 				if condition['retries'] == 1 or (condition['retries'] % 10) == 0:
 					self.log_info('Error getting (%s) value, retrying(#%i)' % (name, condition['retries']))
+#### ExtTransferSwitch event-driven conditions
+				# retries are counted every tick
+				condition['dirty'] = True
 			return False
 
 		elif value is not None and not condition['valid']:
@@ -847,6 +1084,9 @@ class StartStop(object):
 				start = time.time() - condition['start_timer'] >= self._settings[name + 'starttimer']
 				condition['stop_timer'] *= int(not start)
 				self._timer_runnning = True
+#### ExtTransferSwitch event-driven conditions
+				if not start:
+					self._add_deadline(condition['start_timer'] + self._settings[name + 'starttimer'], condition)
 			else:
 				condition['start_timer'] = 0
 
@@ -855,12 +1095,53 @@ class StartStop(object):
 				stop = time.time() - condition['stop_timer'] >= self._settings[name + 'stoptimer']
 				condition['stop_timer'] *= int(not stop)
 				self._timer_runnning = True
+#### ExtTransferSwitch event-driven conditions
+				if not stop:
+					self._add_deadline(condition['stop_timer'] + self._settings[name + 'stoptimer'], condition)
 			else:
 				condition['stop_timer'] = 0
 
 		condition['reached'] = start and not stop
 		return condition['reached']
 
+#### ExtTransferSwitch event-driven conditions
+	def _condition_reached(self, condition):
+		# evaluate again only if an input changed, a timer ran out
+		# or a setting changed, otherwise the last result stands
+		if condition.dirty:
+			condition.dirty = False
+			condition.result = self._evaluate_condition(condition)
+		return condition.result
+
+	def _mark_conditions_dirty(self):
+		for condition in self._condition_stack.values():
+			condition.dirty = True
+
+	def _is_condition_setting(self, setting):
+		# settings that change what a condition evaluates to, the others
+		# (runtime, test run, alarms, ...) are read directly every tick
+		if setting in ('batterymeasurement', 'acloadmeasurement'):
+			return True
+		return any(setting.startswith(name) or setting.startswith('qh_' + name)
+			for name in self._condition_stack)
+
+	def _add_deadline(self, when, condition):
+		# a running timer asks for the same deadline on every evaluation,
+		# only a new one replaces the entry in the heap
+		if condition.deadline == when:
+			return
+		condition.deadline = when
+		self._deadline_sequence += 1
+		heapq.heappush(self._deadlines, (when, self._deadline_sequence, condition))
+
+	def _index_conditions(self):
+		# the services conditions read from may have changed
+		self._condition_inputs = {}
+		for condition in self._condition_stack.values():
+			for key in condition.inputs():
+				self._condition_inputs.setdefault(key, []).append(condition)
+		self._mark_conditions_dirty()
+
 	def _evaluate_manual_start(self):
 		if self._dbusservice['/ManualStart'] == 0:
 			if self._dbusservice['/RunningByCondition'] == 'manual':
@@ -974,9 +1255,13 @@ class StartStop(object):
 
 		if self._dbusservice['/QuietHours'] == 0 and active:
 			self.log_info('Entering to quiet mode')
+#### ExtTransferSwitch event-driven conditions
+			# quiet hours have their own start and stop values
+			self._mark_conditions_dirty()
 
 		elif self._dbusservice['/QuietHours'] == 1 and not active:
 			self.log_info('Leaving quiet mode')
+			self._mark_conditions_dirty()
 
 		self._dbusservice['/QuietHours'] = int(active)
 
@@ -987,28 +1272,18 @@ class StartStop(object):
 		accumulated = seconds - self._last_runtime_update
 
 		self._settings['accumulatedtotal'] = accumulatedtotal = int(self._settings['accumulatedtotal']) + accumulated
-		# Using calendar to get timestamp in UTC, not local time
-		today_date = str(calendar.timegm(datetime.date.today().timetuple()))
 
-		# If something goes wrong getting the json string create a new one
-		try:
-			accumulated_days = json.loads(self._settings['accumulateddaily'])
-		except ValueError:
-			accumulated_days = {today_date: 0}
-
-		if (today_date in accumulated_days):
-			accumulated_days[today_date] += accumulated
-		else:
-			accumulated_days[today_date] = accumulated
+#### ExtTransferSwitch runtime history
+		history = self._get_runtime_history()
+		history.add(self._today_number(), accumulated)
 
 		self._last_runtime_update = seconds
 
-		# Keep the historical with a maximum of HISTORY_DAYS
-		while len(accumulated_days) > HISTORY_DAYS:
-			accumulated_days.pop(min(accumulated_days.keys()), None)
-
-		# Upadate settings
-		self._settings['accumulateddaily'] = json.dumps(accumulated_days, sort_keys=True)
+		# Upadate settings, only if the history changed
+		if history.dirty:
+			history.dirty = False
+			self._accumulateddaily = history.to_json()
+			self._settings['accumulateddaily'] = self._accumulateddaily
 		self._dbusservice['/TodayRuntime'] = self._interval_runtime(0)
 		self._dbusservice['/TestRunIntervalRuntime'] = self._interval_runtime(self._settings['testruninterval'])
 		self._dbusservice['/AccumulatedRuntime'] = accumulatedtotal
@@ -1026,19 +1301,20 @@ class StartStop(object):
 
 
 
-	def _interval_runtime(self, days):
-		summ = 0
-		try:
-			daily_record = json.loads(self._settings['accumulateddaily'])
-		except ValueError:
-			return 0
+#### ExtTransferSwitch runtime history
+	def _today_number(self):
+		# Using calendar to get timestamp in UTC, not local time
+		return calendar.timegm(datetime.date.today().timetuple()) // 86400
 
-		for i in range(days + 1):
-			previous_day = calendar.timegm((datetime.date.today() - datetime.timedelta(days=i)).timetuple())
-			if str(previous_day) in daily_record.keys():
-				summ += daily_record[str(previous_day)] if str(previous_day) in daily_record.keys() else 0
+	def _get_runtime_history(self):
+		# parsed once, then kept in memory
+		if self._runtime_history is None:
+			self._accumulateddaily = self._settings['accumulateddaily']
+			self._runtime_history = RuntimeHistory.from_json(self._accumulateddaily)
+		return self._runtime_history
 
-		return summ
+	def _interval_runtime(self, days):
+		return self._get_runtime_history().total(self._today_number(), days + 1)
 
 	def _get_battery(self):
 		if self._settings['batterymeasurement'] == 'default':
@@ -1128,6 +1404,9 @@ class StartStop(object):
 				self.log_info('Error getting Vebus service!')
 			self._vebusservice = None
 
+#### ExtTransferSwitch event-driven conditions
+		self._index_conditions()
+
 	def _get_servicename_by_instance(self, instance, service_type=None):
 		sv = None
 		services = self._dbusmonitor.get_service_list()
@@ -1162,6 +1441,7 @@ class StartStop(object):
 				self._warmUpEndTime = self._currentTime + warmUpPeriod
 				self.log_info ("starting warm-up")
 				self._dbusservice['/State'] = States.WARMUP
+				self._schedule_deadline (self._warmUpEndTime)
 			# no warm-up go directly to running
 			else:
 				self._dbusservice['/State'] = States.RUNNING
@@ -1177,9 +1457,10 @@ class StartStop(object):
 				# Start request during cool-down run, go back to RUNNING
 				self.log_info ("aborting cool-down - returning to running")
 				self._dbusservice['/State'] = States.RUNNING
+				self._cancel_deadline ()
 
 			elif state == States.WARMUP:
-				if self._currentTime > self._warmUpEndTime:
+				if self._currentTime >= self._warmUpEndTime:
 					self.log_info ("warm-up complete")
 					self._dbusservice['/State'] = States.RUNNING
 
@@ -1206,6 +1487,7 @@ class StartStop(object):
 				if state != States.COOLDOWN:
 					self._dbusservice['/State'] = States.COOLDOWN
 					self.log_info ("starting cool-down")
+					self._schedule_deadline (self._coolDownEndTime)
 				return
 
 			# When we arrive here, a stop command was given and cool-down period has elapesed
@@ -1216,6 +1498,7 @@ class StartStop(object):
 				# delay restoring load to give generator a chance to stop
 				self._postCoolDownEndTime = self._currentTime + WAIT_FOR_ENGINE_STOP
 				self._dbusservice['/State'] = States.STOPPING
+				self._schedule_deadline (self._postCoolDownEndTime)
 				self._update_remote_switch() # Stop engine
 				self.log_info('Stopping generator that was running by %s condition' %
 							str(self._dbusservice['/RunningByCondition']))
@@ -1236,6 +1519,8 @@ class StartStop(object):
 
 			# All other possibilities are handled now. Cooldown is over or not
 			# configured and we waited for the generator to shut down.
+			# a warm-up or cool-down timer may still be pending when stopping directly from it
+			self._cancel_deadline ()
 			self._dbusservice['/State'] = States.STOPPED
 			self._update_remote_switch()
 #### end ExtTransferSwitch warm-up / cool-down
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Tests for the ExtTransferSwitch changes to startstop.py
+#
+# startstop.py needs dbus, GLib and the Venus OS dbus-generator-starter modules
+#	none of those are used by the code under test so empty stand-ins are installed before the import
+#
+# usage: python3 -m unittest discover tests
+
+import os
+import sys
+import types
+import unittest
+
+FILESET = os.path.join (os.path.dirname (os.path.dirname (os.path.abspath (__file__))), 'FileSets', 'v3.20~43')
+
+
+def importStartStop ():
+	def module (name, **attributes):
+		newModule = types.ModuleType (name)
+		newModule.__dict__.update (attributes)
+		sys.modules[name] = newModule
+		return newModule
+
+	enum = lambda **values: type ('Enum', (), values)
+	module ('dbus')
+	clock = types.SimpleNamespace (to_seconds_double=lambda: 0.0)
+	module ('monotonic_time', monotonic_time=lambda: clock)
+	module ('gen_utils', SettingsPrefix=None, Errors=enum (NONE=0), States=enum (STOPPED=0, RUNNING=1,
+			WARMUP=2, COOLDOWN=3, STOPPING=4), enum=enum, create_dbus_service=None)
+	module ('ve_utils', exit_on_error=None)
+	module ('settingsdevice', SettingsDevice=None)
+	gi = module ('gi')
+	gi.repository = module ('gi.repository', GLib=None)
+
+	sys.path.insert (0, FILESET)
+	import startstop
+	return startstop
+
+startstop = importStartStop ()
+
+
+class FakeMonitor:
+
+	def __init__ (self, values):
+		self.values = values
+
+	def get_value (self, service, path, default=None):
+		return self.values.get ((service, path), default)
+
+
+class GeneratorAcInputTest (unittest.TestCase):
+
+	def setUp (self):
+		self.instance = startstop.StartStop (0)
+		self.instance._determineservices = lambda: None
+		self.instance.log_info = lambda message: None
+		self.instance._dbusmonitor = FakeMonitor ({
+			('com.victronenergy.settings', '/Settings/SystemSetup/AcInput1'): 2 })
+
+	# dbus_generator creates instances that stay disabled - they have no dbus service
+	def test_disabled_instance_ignores_new_services (self):
+		self.assertIsNone (self.instance._dbusservice)
+		self.instance.device_added ('com.victronenergy.settings', 0)
+		self.instance.device_added (startstop.SYSTEM_SERVICE, 0)
+		self.assertEqual (self.instance._generatorAcInput, 0)
+
+	def test_enabled_instance_publishes_generator_input (self):
+		self.instance._dbusservice = {}
+		self.instance.device_added ('com.victronenergy.settings', 0)
+		self.assertEqual (self.instance._dbusservice['/GeneratorAcInput'], 1)
+
+
+class FakeGLib:
+
+	def __init__ (self):
+		self.sources = set ()
+
+	def timeout_add (self, delay, *args):
+		source = len (self.sources) + 1
+		self.sources.add (source)
+		return source
+
+	def source_remove (self, source):
+		self.sources.discard (source)
+
+
+class StopGeneratorTest (unittest.TestCase):
+
+	def setUp (self):
+		self.glib = FakeGLib ()
+		self.savedGLib = startstop.GLib
+		startstop.GLib = self.glib
+		self.instance = startstop.StartStop (0)
+		self.instance.log_info = lambda message: None
+		self.instance._get_remote_switch_state = lambda: True
+		self.instance._update_remote_switch = lambda: None
+		self.instance._update_accumulated_time = lambda: None
+		self.instance._dbusservice = { '/State': startstop.States.WARMUP, '/RunningByCondition': 'manual' }
+
+	def tearDown (self):
+		startstop.GLib = self.savedGLib
+
+	# a stop during warm-up with no cool-down goes straight to STOPPED
+	#	the pending warm-up timer must not fire afterwards
+	def test_stop_from_warmup_cancels_deadline (self):
+		self.instance._schedule_deadline (10)
+		self.assertEqual (len (self.glib.sources), 1)
+		self.instance._stop_generator ()
+		self.assertEqual (self.instance._dbusservice['/State'], startstop.States.STOPPED)
+		self.assertIsNone (self.instance._deadlineTimer)
+		self.assertEqual (len (self.glib.sources), 0)
+
+
+if __name__ == '__main__':
+	unittest.main ()